@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+
+import cStringIO
+import getopt
+import imp
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+import make_manifest
+from make_manifest import ManifestMaker, ManifestError
+import manifests
+
+_USAGE = """
+analyze_manifest.py [options] FILE
+
+  Report what makes an enclave's manifest, and so its load time, large.
+
+  FILE is a pre-manifest, which is translated as make_manifest.py would,
+  or a generated Graphene manifest.  The report gives:
+
+    - the size of the manifest.sgx that pal-sgx-sign would write (the
+      manifest plus a checksum per trusted file), which is loaded into
+      the enclave, measured page by page, and parsed by the loader;
+
+    - the bytes and entries of the manifest.sgx that each source gave
+      rise to, largest first, with the number and total size of the
+      trusted files among them, which are hashed when signing and
+      checked when opened.  For a pre-manifest, a source is a directive
+      line; the entries added by post-processing (library mounts, loader
+      settings) and by pal-sgx-sign are listed apart.  For a manifest, a
+      source is the mount whose host directory holds a trusted or
+      allowed file, or else the first component of the key;
+
+    - the memory layout that pal-sgx-sign would compute, with the pages
+      that are measured (EADDed and EEXTENDed) and those that are only
+      EADDed (the heap).
+
+  options
+    -c, --cache-dir PATH
+        A directory in which make_manifest.py caches shared-library
+        dependency closures across runs.
+
+    -g, --graphene GRAPHENE_ROOT
+        Path to the Graphene root directory.
+
+    -h, --help
+        Show this help message and exit.
+
+    -j, --json
+        Write the report as JSON.
+
+    -l, --libpal PATH
+        The libpal to lay out the enclave with.  Defaults to
+        GRAPHENE_ROOT/Runtime/libpal-Linux-SGX.so.
+
+    -o, --output FILE
+        Write the report to FILE rather than stdout.
+
+    -v, --verbose
+        Verbose logging
+
+  args
+    FILE
+        The pre-manifest or manifest to analyze.
+""".strip()
+
+# an entry of a manifest, rather than a directive of a pre-manifest
+_MANIFEST_LINE = re.compile(r'^[\w.]+\s*=')
+
+# a placeholder for what pal-sgx-sign fills in, of the same length
+_DIGEST_PLACEHOLDER = '0' * 64
+
+_GENERATED = '(post-processing)'
+_SIGNING = '(pal-sgx-sign)'
+
+verbose = False
+
+def _usage(exitcode):
+    sys.stderr.write('%s\n' % _USAGE)
+    sys.exit(exitcode)
+
+def _log(tag, fmt, *args):
+    fmt = '[%s] %s' % (tag, fmt)
+    if not fmt.endswith('\n'):
+        fmt += '\n'
+    sys.stderr.write(fmt % args)
+
+def _debug(fmt, *args):
+    if not verbose:
+        return
+    _log('debug', fmt, *args)
+
+def _die(fmt, *args):
+    _log('die', fmt, *args)
+    sys.exit(1)
+
+def _load_sign_tool():
+    # pal-sgx-sign is a script without a .py suffix; load it by path, as
+    # make_sgx.py does
+    if 'pal_sgx_sign' in sys.modules:
+        return sys.modules['pal_sgx_sign']
+    tooldir = os.path.dirname(os.path.abspath(__file__))
+    return imp.load_source('pal_sgx_sign', os.path.join(tooldir,
+                                                        'pal-sgx-sign'))
+
+def is_premanifest(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            return not _MANIFEST_LINE.match(line)
+    return True
+
+def _entry_bytes(key, value):
+    # as manifests.write() writes it
+    return len(key) + len(value) + 4
+
+def _mount_sources(manifest):
+    """
+    Return (names, dirs): a dict mapping the name of each mount of manifest
+    (as in fs.mount.NAME.path) to its source, and a list of (host
+    directory, source) for the chroot mounts, the deepest directory first.
+    """
+    mounts = {}
+    for key, val in manifest.prefixed('fs.mount.'):
+        name, sep, field = key.rpartition('.')
+        mounts.setdefault(name, {})[field] = val
+    names = {}
+    dirs = []
+    for name, mount in mounts.iteritems():
+        names[name] = 'mount %s' % mount.get('path', name)
+        uri = mount.get('uri', '')
+        if mount.get('type') == 'chroot' and uri.startswith('file:'):
+            dirs.append((os.path.normpath(uri[len('file:'):]), names[name]))
+    dirs.sort(reverse=True)
+    return names, dirs
+
+def _manifest_source(key, value, mounts):
+    names, dirs = mounts
+    if key.startswith('fs.mount.'):
+        name = key[len('fs.mount.'):].rpartition('.')[0]
+        return names[name]
+    if key.startswith(('sgx.trusted_files.', 'sgx.allowed_files.')) and \
+            value.startswith('file:'):
+        path = os.path.normpath(value[len('file:'):])
+        for host, source in dirs:
+            if path == host or path.startswith(host.rstrip('/') + '/'):
+                return source
+    return key.split('.', 1)[0]
+
+def analyze(manifest, manifest_path, libpal, sources=None):
+    """
+    Return the report for manifest, a manifests.Manifest read from (or
+    written to) manifest_path, as a dict; relative paths in the manifest
+    are relative to its directory.  sources, if given, maps keys to
+    their (line number, directive), as ManifestMaker.key_sources() does.
+    """
+    sign = _load_sign_tool()
+    mounts = _mount_sources(manifest)
+
+    def source(key):
+        if sources is None:
+            return _manifest_source(key, manifest[key], mounts)
+        where = sources.get(key)
+        if where is None:
+            return _GENERATED
+        return 'line %d: %s' % where
+
+    # the keys that exist before signing, and so where the ones that
+    # pal-sgx-sign adds come from
+    origin = dict((key, source(key)) for key in manifest)
+
+    tmpdir = tempfile.mkdtemp(prefix='analyze_manifest.')
+    try:
+        name = os.path.basename(manifest_path)
+        args = {
+            'output': os.path.join(tmpdir, name + '.sgx'),
+            'libpal': libpal,
+            'manifest': manifest_path,
+        }
+        attr = sign.prepare_manifest(manifest, args)
+
+        # stand-ins, of the right length, for the digests pal-sgx-sign
+        # adds, so that the manifest.sgx has its real size
+        files = {}
+        for key, (uri, path) in sign.trusted_file_targets(manifest, args,
+                False).iteritems():
+            if key == 'exec':
+                where = origin.get('loader.exec', _SIGNING)
+            elif key.startswith('preload'):
+                where = origin.get('loader.preload', _SIGNING)
+            else:
+                where = origin.get('sgx.trusted_files.' + key, _SIGNING)
+            manifest['sgx.trusted_checksum.' + key] = _DIGEST_PLACEHOLDER
+            origin['sgx.trusted_checksum.' + key] = where
+            files[path] = where
+        children = manifest.prefixed('sgx.trusted_children.')
+        for key, uri in children:
+            manifest['sgx.trusted_mrenclave.' + key] = _DIGEST_PLACEHOLDER
+            origin['sgx.trusted_mrenclave.' + key] = \
+                    origin.get('sgx.trusted_children.' + key, _SIGNING)
+
+        try:
+            areas = sign.layout_memory(manifest, manifest.layout, attr, args)
+            layout = _layout_report(sign, attr, areas)
+        except Exception as err:
+            layout = {'error': str(err)}
+    finally:
+        shutil.rmtree(tmpdir)
+
+    buf = cStringIO.StringIO()
+    manifests.write(buf, manifest, manifest.layout, sign.MANIFEST_TRAILER)
+    manifest_bytes = len(buf.getvalue())
+
+    groups = {}
+    def group(where):
+        g = groups.get(where)
+        if g is None:
+            g = groups[where] = {'source': where, 'entries': 0, 'bytes': 0,
+                                 'trusted_files': 0, 'trusted_bytes': 0}
+        return g
+
+    for key, value in manifest.iteritems():
+        g = group(origin.get(key, _SIGNING))
+        g['entries'] += 1
+        g['bytes'] += _entry_bytes(key, value)
+
+    missing = []
+    total_bytes = 0
+    seen = set()
+    for path, where in sorted(files.iteritems()):
+        try:
+            st = os.stat(path)
+        except OSError:
+            missing.append(path)
+            continue
+        g = group(where)
+        g['trusted_files'] += 1
+        g['trusted_bytes'] += st.st_size
+        # a file listed twice is hashed once
+        if (st.st_dev, st.st_ino) not in seen:
+            seen.add((st.st_dev, st.st_ino))
+            total_bytes += st.st_size
+
+    return {
+        'manifest_bytes': manifest_bytes,
+        'manifest_pages': (manifest_bytes + sign.PAGESIZE - 1) //
+                          sign.PAGESIZE,
+        'entries': len(manifest),
+        'sources': sorted(groups.values(),
+                          key=lambda g: (-g['bytes'], g['source'])),
+        'trusted_files': {
+            'files': len(files) - len(missing),
+            'bytes': total_bytes,
+            'missing': missing,
+        },
+        'trusted_children': len(children),
+        'layout': layout,
+    }
+
+def _layout_report(sign, attr, areas):
+    report = {
+        'enclave_size': attr['enclave_size'],
+        'thread_num': attr['thread_num'],
+        'areas': [],
+        'measured_pages': 0,
+        'unmeasured_pages': 0,
+    }
+    for area in sorted(areas, key=lambda a: a.addr, reverse=True):
+        pages = area.size // sign.PAGESIZE
+        report['areas'].append({
+            'desc': area.desc,
+            'addr': area.addr,
+            'size': area.size,
+            'pages': pages,
+            'measured': area.measure,
+        })
+        if area.measure:
+            report['measured_pages'] += pages
+        else:
+            report['unmeasured_pages'] += pages
+    return report
+
+def write_text(f, report):
+    f.write('%s (%s)\n' % (report['input'], report['premanifest'] and
+            'pre-manifest' or 'manifest'))
+    f.write('  manifest.sgx: %d bytes (%d pages), %d entries\n' %
+            (report['manifest_bytes'], report['manifest_pages'],
+             report['entries']))
+    files = report['trusted_files']
+    f.write('  trusted files: %d, %d bytes to hash' %
+            (files['files'], files['bytes']))
+    if files['missing']:
+        f.write(', %d missing' % len(files['missing']))
+    f.write('\n')
+    f.write('  trusted children: %d\n' % report['trusted_children'])
+
+    f.write('\n%12s %9s %9s %14s  %s\n' % ('bytes', 'entries', 'files',
+            'file bytes', 'source'))
+    for g in report['sources']:
+        f.write('%12d %9d %9d %14d  %s\n' % (g['bytes'], g['entries'],
+                g['trusted_files'], g['trusted_bytes'], g['source']))
+
+    layout = report['layout']
+    f.write('\n')
+    if 'error' in layout:
+        f.write('memory layout: not computed: %s\n' % layout['error'])
+        return
+    f.write('memory layout: enclave size %d bytes, %d threads\n' %
+            (layout['enclave_size'], layout['thread_num']))
+    f.write('%18s %14s %9s  %-9s %s\n' % ('address', 'size', 'pages',
+            'measured', 'area'))
+    for area in layout['areas']:
+        f.write('%#18x %14d %9d  %-9s %s\n' % (area['addr'], area['size'],
+                area['pages'], area['measured'] and 'yes' or 'no',
+                area['desc']))
+    f.write('measured pages (EADD + EEXTEND): %d\n' % layout['measured_pages'])
+    f.write('unmeasured pages (EADD only): %d\n' % layout['unmeasured_pages'])
+    for path in files['missing']:
+        f.write('missing trusted file: %s\n' % path)
+
+def main(argv):
+    shortopts = 'c:g:hjl:o:v'
+    longopts = ['cache-dir=', 'graphene=', 'help', 'json', 'libpal=',
+            'output=', 'verbose']
+    # options
+    global verbose
+    cachedir = None
+    graphene = '/usr/src/graphene'
+    as_json = False
+    libpal = None
+    output = None
+
+    try:
+        opts, args = getopt.getopt(argv[1:], shortopts, longopts)
+    except getopt.GetoptError as err:
+        sys.stderr.write('%s\n' % str(err))
+        _usage(1)
+
+    for o, a in opts:
+        if o in ('-c', '--cache-dir'):
+            cachedir = a
+        elif o in ('-g', '--graphene'):
+            graphene = a
+        elif o in ('-h', '--help'):
+            _usage(0)
+        elif o in ('-j', '--json'):
+            as_json = True
+        elif o in ('-l', '--libpal'):
+            libpal = a
+        elif o in ('-o', '--output'):
+            output = a
+        elif o in ('-v', '--verbose'):
+            verbose = True
+        else:
+            assert False, "unhandled option '%s'" % o
+
+    if len(args) != 1:
+        _usage(1)
+
+    make_manifest.verbose = verbose
+    path = args[0]
+    if not libpal:
+        libpal = os.path.join(graphene, 'Runtime', 'libpal-Linux-SGX.so')
+
+    tmpdir = None
+    try:
+        if is_premanifest(path):
+            _debug('translating pre-manifest %s', path)
+            tmpdir = tempfile.mkdtemp(prefix='analyze_manifest.')
+            maker = ManifestMaker(graphene, path,
+                    os.path.join(tmpdir, 'manifest'), cachedir,
+                    incremental=False)
+            # make_manifest.py prints debugging chatter on stdout
+            saved = sys.stdout
+            sys.stdout = sys.stderr
+            try:
+                manifest = maker.make()
+            finally:
+                sys.stdout = saved
+            report = analyze(manifest, maker.out_manifest, libpal,
+                             maker.key_sources())
+            report['premanifest'] = True
+        else:
+            report = analyze(manifests.load(path), path, libpal)
+            report['premanifest'] = False
+        report['input'] = path
+    except (ManifestError, IOError, OSError) as err:
+        _die('%s', str(err))
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+    f = open(output, 'w') if output else sys.stdout
+    try:
+        if as_json:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        else:
+            write_text(f, report)
+    finally:
+        if output:
+            f.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
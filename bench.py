@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+
+import binascii
+import collections
+import fnmatch
+import getopt
+import hashlib
+import imp
+import json
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+_USAGE = """
+bench.py [options]
+
+Benchmark make_manifest.py, pal-sgx-sign and pal-sgx-get-token on
+synthetic inputs.
+
+The inputs -- ELF binaries with various segment layouts, read-only trees
+of 1k, 10k and 100k files, a stand-in Graphene runtime, and a throwaway
+RSA-3072 key -- are generated into a work directory and reused by later
+runs.  Each case runs in a child process, so that its peak RSS is its own,
+and reports the wall and CPU time of every phase (see stats.py).  The
+token cases fetch launch tokens from a fake_aesmd.py run in the child,
+first over a connection per token and then pipelined over one.
+
+Each case also checks its output against golden values recorded from the
+original tools: the MRENCLAVE of the signed enclave, and, for the cases
+that run make_manifest.py, a digest of the generated manifest.  Those cases
+then run make_manifest.py a second time, which reuses its record of the
+first run, and check that manifest too (phase remake_manifest).  A mismatch
+means an optimization changed the output, and makes bench.py exit 1.
+Checks of make_sgx.py's behaviour that time nothing are in check.py.
+
+  options:
+    -b, --baseline FILE
+        Compare the results with those of an earlier run, saved with -o,
+        and print the ratio of each case's and phase's wall time.
+
+    -c, --cases PATTERNS
+        Run only the cases matching one of the comma-separated shell
+        patterns, e.g. 'tree-*,enclave-8G*'.  Use -l to list the cases.
+
+    -h, --help
+        Display this message and exit.
+
+    -l, --list
+        List the cases and exit.
+
+    -o, --output FILE
+        Write the results to FILE as JSON.  Defaults to stdout.
+
+    -r, --repeat N
+        Run each case N times and keep the fastest run.  Defaults to 1.
+
+    -t, --tool-dir PATH
+        The directory holding make_manifest.py and pal-sgx-sign.
+        Defaults to the directory of bench.py.
+
+    -u, --update-golden
+        Record the outputs of this run as the golden values, in
+        bench-golden.json next to bench.py, rather than checking them.
+
+    -w, --workdir PATH
+        Where to generate the inputs.  Defaults to a fixed directory
+        under the system's temporary directory.
+""".strip()
+
+PAGESIZE = 4096
+
+_GOLDEN_NAME = 'bench-golden.json'
+
+# Segment layouts of the synthetic executables: (filesize, memsize, prot)
+# for each PT_LOAD segment, prot being a mask of PF_R(4), PF_W(2), PF_X(1).
+ELF_LAYOUTS = collections.OrderedDict([
+    ('small', [(64 << 10, 64 << 10, 5), (16 << 10, 80 << 10, 6)]),
+    ('many',  [((i + 1) * 3000, (i + 1) * 5000, (5, 4, 6)[i % 3])
+               for i in range(24)]),
+    ('bss',   [(16 << 10, 16 << 10, 5), (4 << 10, 64 << 20, 6)]),
+    ('large', [(32 << 20, 32 << 20, 5), (4 << 20, 6 << 20, 6)]),
+])
+
+# The library OS runtime the cases are signed against.
+PAL_LAYOUT = [(1 << 20, 1 << 20, 5), (64 << 10, 256 << 10, 6)]
+
+TREE_SIZES = collections.OrderedDict([
+    ('1k', 1000),
+    ('10k', 10000),
+    ('100k', 100000),
+])
+
+# (enclave size, threads)
+ENCLAVE_SHAPES = [
+    ('64M', 1),
+    ('64M', 64),
+    ('256M', 4),
+    ('1G', 16),
+    ('8G', 64),
+]
+
+# launch tokens fetched by the token cases
+TOKEN_COUNTS = [1000]
+
+def _cases():
+    cases = collections.OrderedDict()
+    for layout in ELF_LAYOUTS:
+        cases['elf-%s' % layout] = {'kind': 'sign', 'exec': layout,
+                'size': '256M', 'threads': 4}
+    for tree in TREE_SIZES:
+        cases['tree-%s' % tree] = {'kind': 'tree', 'exec': 'small',
+                'tree': tree, 'size': '256M', 'threads': 4}
+    for size, threads in ENCLAVE_SHAPES:
+        cases['enclave-%s-%dt' % (size, threads)] = {'kind': 'sign',
+                'exec': 'small', 'size': size, 'threads': threads}
+    for count in TOKEN_COUNTS:
+        cases['token-%d' % count] = {'kind': 'token', 'exec': 'small',
+                'size': '256M', 'threads': 4, 'tokens': count}
+    return cases
+
+CASES = _cases()
+
+verbose = False
+
+def _usage(exitcode):
+    sys.stderr.write('%s\n' % _USAGE)
+    sys.exit(exitcode)
+
+def _log(tag, fmt, *args):
+    fmt = '[%s] %s' % (tag, fmt)
+    if not fmt.endswith('\n'):
+        fmt += '\n'
+    sys.stderr.write(fmt % args)
+
+def _debug(fmt, *args):
+    if not verbose:
+        return
+    _log('debug', fmt, *args)
+
+def _warn(fmt, *args):
+    _log('warn', fmt, *args)
+
+def _die(fmt, *args):
+    _log('die', fmt, *args)
+    sys.exit(1)
+
+def _mkdir_p(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+#------------------------------------------------------
+# synthetic inputs
+#------------------------------------------------------
+
+def _random_bytes(rng, n):
+    if n == 0:
+        return ''
+    return binascii.unhexlify('%0*x' % (2 * n, rng.getrandbits(8 * n)))
+
+def make_elf(path, layout, seed):
+    """
+    Write a position-independent ELF64 executable whose PT_LOAD segments
+    follow layout, filled with bytes drawn from seed.
+    """
+    rng = random.Random(seed)
+    phoff = 64
+    segments = []
+    offset = PAGESIZE
+    vaddr = 0
+    for filesize, memsize, prot in layout:
+        segments.append((offset, vaddr, filesize, memsize, prot))
+        offset += (filesize + PAGESIZE - 1) // PAGESIZE * PAGESIZE
+        vaddr += (memsize + PAGESIZE - 1) // PAGESIZE * PAGESIZE + PAGESIZE
+
+    ident = '\x7fELF\x02\x01\x01' + '\0' * 9
+    ehdr = struct.pack('<16sHHIQQQIHHHHHH', ident, 3, 62, 1,
+            segments[0][1], phoff, 0, 0, 64, 56, len(segments), 64, 0, 0)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(ehdr)
+        for offset, vaddr, filesize, memsize, prot in segments:
+            f.write(struct.pack('<IIQQQQQQ', 1, prot, offset, vaddr, vaddr,
+                    filesize, memsize, PAGESIZE))
+        for offset, vaddr, filesize, memsize, prot in segments:
+            f.seek(offset)
+            f.write(_random_bytes(rng, filesize))
+    os.rename(tmp, path)
+
+def make_tree(root, nfiles, seed):
+    """
+    Fill root with nfiles files of 0 to 4K bytes, 100 to a directory.
+    """
+    rng = random.Random(seed)
+    tmp = root + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    for i in range(nfiles):
+        d = os.path.join(tmp, 'd%04d' % (i // 100))
+        if i % 100 == 0:
+            os.makedirs(d)
+        with open(os.path.join(d, 'f%06d' % i), 'wb') as f:
+            f.write(_random_bytes(rng, rng.randint(0, 4096)))
+    os.rename(tmp, root)
+
+def make_inputs(workdir, cases):
+    """
+    Generate whatever inputs cases need that workdir does not have yet.
+    """
+    _mkdir_p(os.path.join(workdir, 'bin'))
+    runtime = os.path.join(workdir, 'graphene', 'Runtime')
+    _mkdir_p(runtime)
+
+    for name in ('libpal-Linux-SGX.so', 'ld-linux-x86-64.so.2', 'libsysdb.so'):
+        path = os.path.join(runtime, name)
+        if not os.path.exists(path):
+            make_elf(path, PAL_LAYOUT, name)
+    loader = os.path.join(runtime, 'pal_loader')
+    if not os.path.exists(loader):
+        open(loader, 'w').close()
+
+    for case in cases.values():
+        for layout in set([case['exec']] + case.get('execs', {}).values()):
+            path = os.path.join(workdir, 'bin', 'app-%s' % layout)
+            if not os.path.exists(path):
+                _log('bench', 'generating %s', path)
+                make_elf(path, ELF_LAYOUTS[layout], layout)
+        if 'tree' in case:
+            path = os.path.join(workdir, 'tree-%s' % case['tree'])
+            if not os.path.exists(path):
+                _log('bench', 'generating %s', path)
+                make_tree(path, TREE_SIZES[case['tree']], case['tree'])
+
+    key = os.path.join(workdir, 'key.pem')
+    if not os.path.exists(key):
+        _log('bench', 'generating %s', key)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['openssl', 'genrsa', '-3', '-out',
+                    key + '.tmp', '3072'], stderr=devnull)
+        os.rename(key + '.tmp', key)
+
+#------------------------------------------------------
+# running a case (in the child)
+#------------------------------------------------------
+
+def _load_tool(tooldir, name):
+    modname = name.replace('-', '_')
+    if modname.endswith('.py'):
+        modname = modname[:-3]
+    if tooldir not in sys.path:
+        sys.path.insert(0, tooldir)
+    return imp.load_source(modname, os.path.join(tooldir, name))
+
+def _tree_files(root):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            paths.append(os.path.join(dirpath, name))
+    return paths
+
+def _write_manifest(path, case):
+    # Paths are relative to the work directory, so the measurement, which
+    # covers the manifest, does not depend on where the inputs live.
+    lines = [
+        'loader.exec = file:bin/app-%s' % case['exec'],
+        'sgx.enclave_size = %s' % case['size'],
+        'sgx.thread_num = %d' % case['threads'],
+        'sgx.trusted_files.ld = file:graphene/Runtime/ld-linux-x86-64.so.2',
+    ]
+    if 'tree' in case:
+        for i, p in enumerate(_tree_files('tree-%s' % case['tree'])):
+            lines.append('sgx.trusted_files.t%d = file:%s' % (i, p))
+    with open(path, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+def _make_manifest(tool, workdir, name, case, stats, full=True):
+    premanifest = os.path.join('out', name + '.conf')
+    out_manifest = os.path.join('out', name + '.gen.manifest')
+    if full and hasattr(tool, 'DEPS_SUFFIX'):
+        # drop the record of the last run, which would make this one
+        # incremental
+        try:
+            os.unlink(out_manifest + tool.DEPS_SUFFIX)
+        except OSError:
+            pass
+    with open(premanifest, 'w') as f:
+        f.write('ENCLAVE_SIZE %d\n' % (int(case['size'][:-1]) *
+                {'M': 1, 'G': 1024}[case['size'][-1]]))
+        f.write('THREADS %d\n' % case['threads'])
+        # relative to the work directory, which run_case() runs in
+        f.write('MOUNT file:tree-%s /data chroot ro\n' % case['tree'])
+
+    # make_manifest.py prints debugging chatter on stdout
+    saved = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        maker = tool.ManifestMaker('graphene', premanifest, out_manifest,
+                stats=stats)
+        maker.make()
+    finally:
+        sys.stdout = saved
+    with open(maker.out_manifest) as f:
+        text = f.read()
+    # make_manifest.py makes the paths absolute, and the trusted-file keys
+    # from them, so take the work directory out of both
+    text = text.replace(workdir, '@WORKDIR@')
+    text = text.replace(maker._make_name(workdir), '@WORKDIR@')
+    return hashlib.sha256(text).hexdigest()
+
+def _get_tokens(tooldir, sign, sigstruct, count, stats):
+    fake = _load_tool(tooldir, 'fake_aesmd.py')
+    tool = _load_tool(tooldir, 'pal-sgx-get-token')
+    attr = tool.read_sigstruct(str(sigstruct))
+    server = fake.FakeAesmd(os.path.abspath(os.path.join('out',
+            'aesmd.socket')))
+    server.start()
+    try:
+        with stats.phase('token_serial'):
+            for i in range(count):
+                client = tool.AesmClient(server.path)
+                client.get_token(attr)
+                client.close()
+        stats.count('token_serial', 'tokens', count)
+
+        with stats.phase('token'):
+            client = tool.AesmClient(server.path)
+            for error, token in client.request_tokens([attr] * count):
+                assert error == 0
+            client.close()
+        stats.count('token', 'tokens', count)
+    finally:
+        server.stop()
+
+def run_case(name, tooldir, workdir, result_path):
+    stats_mod = _load_tool(tooldir, 'stats.py')
+    case = CASES[name]
+    os.chdir(workdir)
+    _mkdir_p('out')
+    stats = stats_mod.Stats()
+    result = collections.OrderedDict()
+
+    wall = time.time()
+    if case['kind'] == 'tree':
+        tool = _load_tool(tooldir, 'make_manifest.py')
+        with stats.phase('make_manifest'):
+            result['manifest_digest'] = _make_manifest(tool, workdir, name,
+                    case, stats)
+
+    sign = _load_tool(tooldir, 'pal-sgx-sign')
+    manifest = os.path.join('out', name + '.manifest')
+    _write_manifest(manifest, case)
+    args = {
+        'output': os.path.join('out', name + '.manifest.sgx'),
+        'libpal': 'graphene/Runtime/libpal-Linux-SGX.so',
+        'key': 'key.pem',
+        'manifest': manifest,
+        'exec': 'bin/app-%s' % case['exec'],
+        'stats': stats,
+        'quiet': True,
+    }
+    with stats.phase('sign_manifest'):
+        with stats.phase('read_manifest'):
+            m, layout = sign.read_manifest(manifest)
+        sigstruct = sign.sign(m, layout, args)
+
+    if case['kind'] == 'token':
+        _get_tokens(tooldir, sign, sigstruct, case['tokens'], stats)
+    wall = time.time() - wall
+
+    if case['kind'] == 'tree' and hasattr(tool, 'DEPS_SUFFIX'):
+        # again, with nothing changed, from make_manifest.py's record of
+        # the first run; not counted in the case's wall time
+        with stats.phase('remake_manifest'):
+            result['remake_digest'] = _make_manifest(tool, workdir, name,
+                    case, stats_mod.NULL_STATS, False)
+
+    result['mrenclave'] = binascii.hexlify(str(sigstruct[960:992]))
+    _write_result(result_path, result, wall, stats)
+
+def _write_result(result_path, result, wall, stats):
+    result['wall'] = round(wall, 6)
+    # ru_maxrss is in KiB on Linux
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['phases'] = stats.as_dict()['phases']
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+#------------------------------------------------------
+# driver
+#------------------------------------------------------
+
+def _spawn_case(name, tooldir, workdir):
+    fd, result_path = tempfile.mkstemp(prefix='bench-%s.' % name)
+    os.close(fd)
+    try:
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-case', name,
+               '--tool-dir', tooldir, '--workdir', workdir,
+               '--result', result_path]
+        _debug('running %s', ' '.join(cmd))
+        # the tools' own chatter is only of interest when a case fails
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        out = p.communicate()[0]
+        if verbose or p.returncode:
+            sys.stderr.write(out)
+        if p.returncode:
+            _die('case %s failed with status %d', name, p.returncode)
+        with open(result_path) as f:
+            return json.load(f, object_pairs_hook=collections.OrderedDict)
+    finally:
+        os.unlink(result_path)
+
+def _golden_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        _GOLDEN_NAME)
+
+def _load_golden():
+    try:
+        with open(_golden_path()) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+def _check_golden(name, result, golden):
+    expected = golden.get(name)
+    if expected is None:
+        _warn('%s: no golden values', name)
+        return True
+    ok = True
+    for key, golden_key in (('mrenclave', 'mrenclave'),
+                            ('manifest_digest', 'manifest_digest'),
+                            ('remake_digest', 'manifest_digest')):
+        if key not in result or golden_key not in expected:
+            continue
+        if result[key] != expected[golden_key]:
+            _warn('%s: %s is %s, expected %s', name, key, result[key],
+                    expected[golden_key])
+            ok = False
+    return ok
+
+def _compare(results, baseline):
+    lines = []
+    for name, result in results.iteritems():
+        old = baseline.get('cases', {}).get(name)
+        if old is None:
+            continue
+        lines.append('%-22s %9.3fs %9.3fs %6.2fx' % (name, old['wall'],
+                result['wall'], result['wall'] / max(old['wall'], 1e-9)))
+        for phase, entry in result['phases'].iteritems():
+            oldphase = old['phases'].get(phase)
+            if oldphase is None:
+                continue
+            lines.append('  %-20s %9.3fs %9.3fs %6.2fx' % (phase,
+                    oldphase['wall'], entry['wall'],
+                    entry['wall'] / max(oldphase['wall'], 1e-9)))
+    if lines:
+        sys.stderr.write('%-22s %10s %10s %7s\n' % ('case', 'baseline',
+                'now', 'ratio'))
+        sys.stderr.write('\n'.join(lines) + '\n')
+
+def main(argv):
+    shortopts = 'b:c:hlo:r:t:uvw:'
+    longopts = ['baseline=', 'cases=', 'help', 'list', 'output=', 'repeat=',
+            'tool-dir=', 'update-golden', 'verbose', 'workdir=',
+            'run-case=', 'result=']
+    # options
+    baseline = None
+    patterns = None
+    output = None
+    repeat = 1
+    tooldir = os.path.dirname(os.path.abspath(__file__))
+    update_golden = False
+    workdir = os.path.join(tempfile.gettempdir(), 'makemanifest-bench')
+    # internal: run one case in this process
+    run = None
+    result_path = None
+    global verbose
+
+    try:
+        opts, args = getopt.getopt(argv[1:], shortopts, longopts)
+    except getopt.GetoptError as err:
+        sys.stderr.write('%s\n' % str(err))
+        _usage(1)
+
+    for o, a in opts:
+        if o in ('-b', '--baseline'):
+            baseline = a
+        elif o in ('-c', '--cases'):
+            patterns = a.split(',')
+        elif o in ('-h', '--help'):
+            _usage(0)
+        elif o in ('-l', '--list'):
+            for name, case in CASES.iteritems():
+                print '%-22s %s' % (name, ' '.join('%s=%s' % kv
+                        for kv in sorted(case.items())))
+            return
+        elif o in ('-o', '--output'):
+            output = a
+        elif o in ('-r', '--repeat'):
+            try:
+                repeat = int(a)
+            except ValueError:
+                sys.stderr.write('error: --repeat must be an integer\n')
+                _usage(1)
+        elif o in ('-t', '--tool-dir'):
+            tooldir = os.path.abspath(a)
+        elif o in ('-u', '--update-golden'):
+            update_golden = True
+        elif o in ('-v', '--verbose'):
+            verbose = True
+        elif o in ('-w', '--workdir'):
+            workdir = a
+        elif o == '--run-case':
+            run = a
+        elif o == '--result':
+            result_path = a
+        else:
+            assert False, "unhandled option '%s'" % o
+
+    workdir = os.path.abspath(workdir)
+    if run:
+        run_case(run, tooldir, workdir, result_path)
+        return
+
+    cases = collections.OrderedDict((name, case)
+            for name, case in CASES.iteritems()
+            if not patterns or
+               any(fnmatch.fnmatch(name, p) for p in patterns))
+    if not cases:
+        _die('no cases match %s', ','.join(patterns))
+
+    make_inputs(workdir, cases)
+
+    golden = _load_golden()
+    results = collections.OrderedDict()
+    ok = True
+    for name in cases:
+        best = None
+        for i in range(repeat):
+            _log('bench', 'running %s', name)
+            result = _spawn_case(name, tooldir, workdir)
+            if best is None or result['wall'] < best['wall']:
+                best = result
+        results[name] = best
+        _log('bench', '%s: %.3fs, peak rss %d KiB', name, best['wall'],
+                best['peak_rss_kb'])
+        if update_golden:
+            golden[name] = dict((k, best[k]) for k in
+                    ('mrenclave', 'manifest_digest') if k in best)
+        elif not _check_golden(name, best, golden):
+            ok = False
+
+    if update_golden:
+        with open(_golden_path(), 'w') as f:
+            json.dump(golden, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    doc = collections.OrderedDict()
+    doc['python'] = sys.version.split()[0]
+    doc['time'] = int(time.time())
+    doc['cases'] = results
+    if output:
+        with open(output, 'w') as f:
+            json.dump(doc, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(doc, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if baseline:
+        with open(baseline) as f:
+            _compare(results, json.load(f,
+                    object_pairs_hook=collections.OrderedDict))
+
+    if not ok:
+        _die('outputs differ from the golden values')
+
+if __name__ == '__main__':
+    main(sys.argv)
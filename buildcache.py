@@ -0,0 +1,191 @@
+"""
+A content-addressed cache of whole enclave builds: the manifest, the signed
+manifest.sgx and its sigstruct.
+
+A build is looked up in two steps.  The caller first names the build by a
+base key, a digest of what is known before the build runs -- e.g. the
+paths of the premanifest and the signing key, the working directory and
+environment the premanifest is translated in, the generated_offsets
+values and the sigstruct date.  Under the base key the cache records the
+files (the premanifest, the key, libpal, the tools, every trusted file)
+and read-only trees that the last such build read, and the other paths,
+such as library search directories, whose metadata it depended on.  The
+build's full key adds the digests of those files, found through the
+checksum cache (so an unchanged file costs one stat), the listing of each
+tree, so that a file added to or removed from a read-only mount is
+noticed, and the stat key of each other path.  The outputs are stored
+under the full key, and a build whose inputs all match is copied back
+rather than redone.  The full key is computed after the build, so a build
+whose inputs changed while it ran is not stored: its outputs were made
+from content the key no longer describes.
+
+Entries live under cachedir/builds and are written with a rename, so the
+cache may be shared by concurrent builds.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from checksums import hash_files, DEFAULT_JOBS
+import treewalk
+
+# A superset of any mount's walk policy: every file, with symlinked
+# directories followed.
+_FINGERPRINT_POLICY = treewalk.WalkPolicy((), (), treewalk.FOLLOW,
+        treewalk.KEEP, treewalk.KEEP)
+
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def base_key(items):
+    """
+    Return the base key for items, a list of (name, value) strings.
+    """
+    digest = hashlib.sha256()
+    for name, value in items:
+        digest.update('%s\0%d\0%s\0' % (name, len(value), value))
+    return digest.hexdigest()
+
+def _changed_since(st, started):
+    return st is None or st.st_ctime >= started
+
+def _tree_listing(root):
+    files = treewalk.walk_tree(root, _FINGERPRINT_POLICY)
+    prefix = root.rstrip('/') + '/'
+    return sorted(path[len(prefix):] for path, st in files)
+
+class BuildCache:
+    def __init__(self, cachedir, checksum_cache=None, jobs=DEFAULT_JOBS):
+        self.dir = os.path.join(cachedir, 'builds')
+        self.checksum_cache = checksum_cache
+        self.jobs = jobs
+
+    def _path(self, name):
+        return os.path.join(self.dir, name)
+
+    def _full_key(self, base, inputs, trees, stamped):
+        # None if an input is gone
+        try:
+            digests = hash_files(inputs, self.jobs, self.checksum_cache)
+        except (IOError, OSError):
+            return None
+        digest = hashlib.sha256(base)
+        for path in sorted(inputs):
+            digest.update('file\0%s\0%s\0' % (path, digests[path]))
+        for root in sorted(trees):
+            digest.update('tree\0%s\0' % root)
+            for relpath in _tree_listing(root):
+                digest.update(relpath + '\0')
+        for path in sorted(stamped):
+            digest.update('stamp\0%s\0%s\0' % (path, treewalk.stamp(path)))
+        return digest.hexdigest()
+
+    def lookup(self, base, names):
+        """
+        Return the directory holding the outputs names of a build with base
+        key base and the same inputs, or None.
+        """
+        try:
+            with open(self._path(base + '.json')) as f:
+                record = json.load(f)
+        except (IOError, ValueError):
+            return None
+        key = self._full_key(base, [str(p) for p in record['inputs']],
+                             [str(p) for p in record['trees']],
+                             [str(p) for p in record.get('stamped', ())])
+        if key is None:
+            return None
+        path = self._path(key)
+        for name in names:
+            if not os.path.exists(os.path.join(path, name)):
+                return None
+        return path
+
+    def clock(self):
+        """
+        Return the current time as the filesystem stamps it, to pass to
+        store() as the start of a build.  File times come from a coarser
+        clock than time.time(), so the two cannot be compared.
+        """
+        _mkdir_p(self.dir)
+        fd, tmp = tempfile.mkstemp(prefix='clock.', dir=self.dir)
+        try:
+            return os.fstat(fd).st_ctime
+        finally:
+            os.close(fd)
+            os.unlink(tmp)
+
+    def _changed_during_build(self, inputs, trees, stamped, started):
+        for path in inputs + stamped + trees:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if _changed_since(st, started):
+                return True
+        for root in trees:
+            for path, st in treewalk.walk_tree(root, _FINGERPRINT_POLICY):
+                if _changed_since(st, started):
+                    return True
+        return False
+
+    def store(self, base, inputs, trees, outputs, stamped=(), started=None):
+        """
+        Record that the build with base key base read the files inputs,
+        walked the trees and depended on the metadata of the paths stamped,
+        and save outputs, a dict of name -> path.  started is the clock() at
+        which the build began reading its inputs; if any of them has changed
+        since, nothing is stored.  Return True if the build was stored.
+        """
+        inputs = sorted(set(inputs))
+        trees = sorted(set(trees))
+        stamped = sorted(set(stamped))
+        key = self._full_key(base, inputs, trees, stamped)
+        if key is None:
+            return False
+        # checked after hashing, so a change made before the key was taken
+        # is always seen
+        if started is not None and \
+                self._changed_during_build(inputs, trees, stamped, started):
+            return False
+        _mkdir_p(self.dir)
+
+        path = self._path(key)
+        if not os.path.isdir(path):
+            tmp = tempfile.mkdtemp(prefix=key + '.', dir=self.dir)
+            os.chmod(tmp, 0o755)
+            for name, src in outputs.iteritems():
+                shutil.copy2(src, os.path.join(tmp, name))
+            try:
+                os.rename(tmp, path)
+            except OSError as e:
+                # another build stored the same outputs first
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+                shutil.rmtree(tmp)
+
+        fd, tmp = tempfile.mkstemp(prefix=base + '.json.', dir=self.dir)
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'inputs': inputs, 'trees': trees, 'stamped': stamped},
+                      f)
+        os.rename(tmp, self._path(base + '.json'))
+        return True
+
+    def restore(self, path, outputs):
+        """
+        Copy the outputs found by lookup() at path to outputs, a dict of
+        name -> destination path.
+        """
+        for name, dst in outputs.iteritems():
+            if os.path.dirname(dst):
+                _mkdir_p(os.path.dirname(dst))
+            shutil.copy2(os.path.join(path, name), dst)
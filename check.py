@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+import collections
+import fnmatch
+import getopt
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+
+import bench
+
+_USAGE = """
+check.py [options]
+
+Regression checks for make_sgx.py's build cache and watch mode.
+
+Unlike bench.py's cases, these time nothing: each packages small synthetic
+enclaves through make_sgx.py in-process and fails if the outputs are wrong.
+The inputs are generated by bench.py's code into a work directory and
+reused by later runs.  check.py exits 1 if any check fails.
+
+  build-cache-cwd
+    Package one premanifest, whose EXEC is a relative path, from two
+    directories holding different executables through the build cache,
+    and fail unless each gets its own manifest and only an unchanged
+    rebuild is restored from the cache.
+
+  build-cache-changed-input
+    Change the executable while a build runs, after it was read, and fail
+    if the build is stored in the cache under the new executable's key.
+
+  watch-resign
+    Translate a premanifest with an automatic enclave size once and sign it
+    twice in one Maker, as a watch rebuild does when only a signing input
+    changed, from a directory other than the output directory, and fail
+    unless both signings write the same manifest.sgx and .sig into the
+    output directory and nothing into the working directory.
+
+  watch-failed-rebuild
+    Run watch mode with scripted changes: a premanifest edit whose
+    translation fails, then a key change.  Fail unless the rebuild after
+    the key change translates the edited premanifest.
+
+  options:
+    -c, --checks PATTERNS
+        Run only the checks matching one of the comma-separated shell
+        patterns, e.g. 'watch-*'.  Use -l to list the checks.
+
+    -h, --help
+        Display this message and exit.
+
+    -l, --list
+        List the checks and exit.
+
+    -t, --tool-dir PATH
+        The directory holding make_sgx.py and the tools it runs.
+        Defaults to the directory of check.py.
+
+    -v, --verbose
+        Print the tools' output and the traceback of a failed check.
+
+    -w, --workdir PATH
+        Where to generate the inputs.  Defaults to a fixed directory
+        under the system's temporary directory.
+""".strip()
+
+# the inputs the checks need, in the form of bench.py's cases
+_INPUTS = {'check': {'exec': 'small', 'execs': {'a': 'small', 'b': 'many'}}}
+
+verbose = False
+
+def _usage(exitcode):
+    sys.stderr.write('%s\n' % _USAGE)
+    sys.exit(exitcode)
+
+def _log(tag, fmt, *args):
+    fmt = '[%s] %s' % (tag, fmt)
+    if not fmt.endswith('\n'):
+        fmt += '\n'
+    sys.stderr.write(fmt % args)
+
+class _Check:
+    def __init__(self, name, tooldir, workdir):
+        self.name = name
+        self.tooldir = tooldir
+        self.workdir = workdir
+        self.make_sgx = bench._load_tool(tooldir, 'make_sgx.py')
+        self.root = os.path.join(workdir, 'out', name)
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        bench._mkdir_p(self.root)
+        self.graphene = os.path.join(workdir, 'graphene')
+        self.keyfile = os.path.join(workdir, 'key.pem')
+
+    def app(self, layout):
+        return os.path.join(self.workdir, 'bin', 'app-%s' % layout)
+
+    def premanifest(self, lines):
+        path = os.path.join(self.root, 'app.conf')
+        with open(path, 'w') as f:
+            for line in lines:
+                f.write(line + '\n')
+        return path
+
+    def maker(self, outdir, cachedir=None):
+        maker = self.make_sgx.Maker(self.graphene, outdir, self.tooldir,
+                False, cachedir, None, True)
+        maker.quiet = True
+        return maker
+
+    def fail(self, fmt, *args):
+        raise AssertionError(fmt % args)
+
+def check_build_cache_cwd(c):
+    premanifest = c.premanifest(['EXEC file:app', 'ENCLAVE_SIZE 256',
+                                 'THREADS 4'])
+    dirs = sorted(_INPUTS['check']['execs'])
+    for d in dirs:
+        bench._mkdir_p(os.path.join(c.root, d))
+        shutil.copy(c.app(_INPUTS['check']['execs'][d]),
+                    os.path.join(c.root, d, 'app'))
+
+    restored = []
+    for d in dirs + dirs[:1]:
+        os.chdir(os.path.join(c.root, d))
+        maker = c.maker('out', os.path.join(c.root, 'cache'))
+        hit = maker.restore_build(premanifest, c.keyfile)
+        if not hit:
+            maker.make_manifest(premanifest)
+            maker.sign_manifest(c.keyfile)
+            maker.save_build(premanifest, c.keyfile)
+        restored.append(hit)
+        with open(os.path.join('out', 'manifest')) as f:
+            exec_line = 'loader.exec = file:%s\n' % \
+                    os.path.join(c.root, d, 'app')
+            if exec_line not in f.read():
+                c.fail('the manifest built in %s is not for its executable', d)
+    if restored != [False] * len(dirs) + [True]:
+        c.fail('restored from the build cache: %s', restored)
+
+def check_build_cache_changed_input(c):
+    app = os.path.join(c.root, 'app')
+    shutil.copy(c.app('small'), app)
+    premanifest = c.premanifest(['EXEC file:%s' % app, 'ENCLAVE_SIZE 256',
+                                 'THREADS 4'])
+    cachedir = os.path.join(c.root, 'cache')
+    outdir = os.path.join(c.root, 'out')
+
+    maker = c.maker(outdir, cachedir)
+    maker.make_manifest(premanifest)
+    maker.sign_manifest(c.keyfile)
+    # an edit that lands after the build read the executable
+    shutil.copy(c.app('many'), app)
+    maker.save_build(premanifest, c.keyfile)
+
+    if c.maker(outdir, cachedir).restore_build(premanifest, c.keyfile):
+        c.fail('a build made from the old executable was restored for '
+               'the new one')
+
+def check_watch_resign(c):
+    premanifest = c.premanifest(['EXEC file:%s' % c.app('small'),
+                                 'ENCLAVE_SIZE auto', 'THREADS 4'])
+    outdir = os.path.join(c.root, 'out')
+    os.chdir(c.root)
+    maker = c.maker(outdir)
+    maker.make_manifest(premanifest)
+    signed = []
+    for i in range(2):
+        maker.sign_manifest(c.keyfile)
+        strays = [p for p in os.listdir(c.root) if p.endswith('.sig')]
+        if strays:
+            c.fail('signing wrote %s into the working directory',
+                   ', '.join(strays))
+        outputs = []
+        for out in ('manifest.sgx', 'manifest.sgx.sig'):
+            with open(os.path.join(outdir, out), 'rb') as f:
+                outputs.append(f.read())
+        signed.append(outputs)
+        os.remove(os.path.join(outdir, 'manifest.sgx.sig'))
+    if signed[0] != signed[1]:
+        c.fail('re-signing changed the output')
+
+class _Done(Exception):
+    pass
+
+class _ScriptedWatcher:
+    """
+    Stands in for watch.py's watchers: each wait() runs the next step of
+    script, which returns the changes to report.
+    """
+    def __init__(self, script):
+        self.script = list(script)
+
+    def update(self, files, trees):
+        pass
+
+    def wait(self, debounce):
+        if not self.script:
+            raise _Done()
+        return self.script.pop(0)()
+
+    def close(self):
+        pass
+
+def check_watch_failed_rebuild(c):
+    lines = ['EXEC file:%s' % c.app('small'), 'ENCLAVE_SIZE 256']
+    premanifest = c.premanifest(lines + ['THREADS 4'])
+    outdir = os.path.join(c.root, 'out')
+    sgx = os.path.join(outdir, 'out.manifest.sgx')
+    maker = c.maker(outdir)
+    # no aesmd here; the check is about what gets signed
+    maker.get_token = lambda: None
+
+    translate = maker._make_manifest
+    failures = []
+    def make_manifest(premanifest):
+        if failures:
+            failures.pop()
+            raise Exception('injected translation failure')
+        translate(premanifest)
+    maker._make_manifest = make_manifest
+
+    def edit_premanifest():
+        c.premanifest(lines + ['THREADS 8'])
+        failures.append(True)
+        return [(premanifest, c.make_sgx.MODIFIED)]
+    def change_key():
+        if os.path.exists(sgx):
+            c.fail('the translation was injected to fail, but signed')
+        return [(os.path.abspath(c.keyfile), c.make_sgx.MODIFIED)]
+    def check_signed():
+        with open(sgx) as f:
+            if 'sgx.thread_num = 8\n' not in f.read():
+                c.fail('the rebuild after a failed one signed the stale '
+                       'translation')
+        raise _Done()
+
+    def removing_output(step):
+        def run():
+            if os.path.exists(sgx):
+                os.remove(sgx)
+            return step()
+        return run
+
+    saved = c.make_sgx.make_watcher
+    c.make_sgx.make_watcher = lambda: _ScriptedWatcher([
+            removing_output(edit_premanifest), change_key, check_signed])
+    try:
+        maker.watch(premanifest, c.keyfile, 0)
+    except _Done:
+        pass
+    finally:
+        c.make_sgx.make_watcher = saved
+
+CHECKS = collections.OrderedDict([
+    ('build-cache-cwd', check_build_cache_cwd),
+    ('build-cache-changed-input', check_build_cache_changed_input),
+    ('watch-resign', check_watch_resign),
+    ('watch-failed-rebuild', check_watch_failed_rebuild),
+])
+
+def run_check(name, tooldir, workdir):
+    """
+    Run the check name and return True if it passed.
+    """
+    # the tools print debugging chatter on stdout and stderr
+    saved = sys.stdout, sys.stderr
+    if not verbose:
+        sys.stdout = sys.stderr = tempfile.TemporaryFile()
+    try:
+        CHECKS[name](_Check(name, tooldir, workdir))
+    except Exception as err:
+        output = None
+        if not verbose:
+            sys.stderr.seek(0)
+            output = sys.stderr.read()
+        sys.stdout, sys.stderr = saved
+        if verbose:
+            traceback.print_exc()
+        elif not isinstance(err, AssertionError):
+            sys.stderr.write(output)
+        _log('check', '%s: FAIL: %s', name, str(err))
+        return False
+    finally:
+        sys.stdout, sys.stderr = saved
+        os.chdir(workdir)
+    _log('check', '%s: ok', name)
+    return True
+
+def main(argv):
+    shortopts = 'c:hlt:vw:'
+    longopts = ['checks=', 'help', 'list', 'tool-dir=', 'verbose', 'workdir=']
+    # options
+    patterns = None
+    tooldir = os.path.dirname(os.path.abspath(__file__))
+    workdir = os.path.join(tempfile.gettempdir(), 'makemanifest-check')
+    global verbose
+
+    try:
+        opts, args = getopt.getopt(argv[1:], shortopts, longopts)
+    except getopt.GetoptError as err:
+        sys.stderr.write('%s\n' % str(err))
+        _usage(1)
+
+    for o, a in opts:
+        if o in ('-c', '--checks'):
+            patterns = a.split(',')
+        elif o in ('-h', '--help'):
+            _usage(0)
+        elif o in ('-l', '--list'):
+            for name in CHECKS:
+                print name
+            return
+        elif o in ('-t', '--tool-dir'):
+            tooldir = os.path.abspath(a)
+        elif o in ('-v', '--verbose'):
+            verbose = True
+        elif o in ('-w', '--workdir'):
+            workdir = a
+        else:
+            assert False, "unhandled option '%s'" % o
+
+    workdir = os.path.abspath(workdir)
+    names = [name for name in CHECKS if not patterns or
+             any(fnmatch.fnmatch(name, p) for p in patterns)]
+    if not names:
+        bench._die('no checks match %s', ','.join(patterns))
+
+    bench.make_inputs(workdir, _INPUTS)
+    os.chdir(workdir)
+    failed = [name for name in names
+              if not run_check(name, tooldir, workdir)]
+    if failed:
+        _log('die', '%d of %d checks failed', len(failed), len(names))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,344 @@
+"""
+Trusted-file checksums: a streaming, parallel SHA-256 engine and a
+persistent cache.
+
+Cache entries are keyed on a file's (device, inode, size, mtime_ns,
+ctime_ns), so an unchanged file costs a single stat.  The cache is an
+append-only log in a directory that may be shared by several concurrent
+jobs: every writer holds an exclusive lock on a sidecar lock file, and
+compaction (eviction) rewrites the log atomically with a rename.
+Compaction runs once the log holds more than twice max_entries records, or
+once its oldest record is older than 1.5 * max_age, so even in a small cache
+an entry unused for max_age drops out within another max_age / 2.
+
+Files are read in fixed-size chunks on a thread pool (hashlib releases the
+GIL while hashing large buffers), so peak memory is O(jobs * chunk_size)
+regardless of file size.
+"""
+
+import errno
+import fcntl
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+_LOG_NAME = 'checksums'
+_LOCK_NAME = 'checksums.lock'
+
+DEFAULT_MAX_ENTRIES = 1000000
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_JOBS = multiprocessing.cpu_count()
+
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _ns(st, name):
+    ns = getattr(st, name + '_ns', None)
+    if ns is None:
+        ns = int(getattr(st, name) * 1000000000)
+    return ns
+
+def stat_key(st):
+    return '%d:%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size,
+            _ns(st, 'st_mtime'), _ns(st, 'st_ctime'))
+
+class _Lock:
+    def __init__(self, path, op):
+        self.path = path
+        self.op = op
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, self.op)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+class ChecksumCache:
+    """
+    With cachedir None, the cache lives only in memory; that still lets
+    several builds in one process share their digests.  The cache may be
+    used from several threads.
+    """
+    def __init__(self, cachedir, max_entries=DEFAULT_MAX_ENTRIES,
+            max_age=DEFAULT_MAX_AGE):
+        self.cachedir = cachedir
+        self.max_entries = max_entries
+        self.max_age = max_age
+        # key -> (hexdigest, stamp)
+        self._entries = {}
+        self._pending = []
+        self._nrecords = 0
+        # stamp of the oldest record in the log, live or superseded
+        self._oldest = None
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        # stat key -> Event, for files some thread is currently hashing
+        self._inflight = {}
+
+    def _path(self, name):
+        return os.path.join(self.cachedir, name)
+
+    def _read_log(self):
+        entries = {}
+        nrecords = 0
+        oldest = None
+        try:
+            f = open(self._path(_LOG_NAME), 'r')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return entries, nrecords, oldest
+        with f:
+            for line in f:
+                # a job killed mid-write may leave a torn record; skip it
+                fields = line.split()
+                if len(fields) != 3 or len(fields[2]) != 64:
+                    continue
+                try:
+                    stamp = int(fields[1])
+                except ValueError:
+                    continue
+                entries[fields[0]] = (fields[2], stamp)
+                nrecords += 1
+                if oldest is None or stamp < oldest:
+                    oldest = stamp
+        return entries, nrecords, oldest
+
+    def load(self):
+        with self._lock:
+            if self.cachedir:
+                _mkdir_p(self.cachedir)
+                with _Lock(self._path(_LOCK_NAME), fcntl.LOCK_SH):
+                    self._entries, self._nrecords, self._oldest = \
+                            self._read_log()
+            self._loaded = True
+
+    def lookup(self, st):
+        key = stat_key(st)
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            hexdigest, stamp = entry
+            # keep hot entries from aging out without rewriting them on
+            # every hit
+            now = int(time.time())
+            if now - stamp > self.max_age // 2:
+                self._entries[key] = (hexdigest, now)
+                self._pending.append((key, now, hexdigest))
+            return hexdigest
+
+    def store(self, st, hexdigest):
+        key = stat_key(st)
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            now = int(time.time())
+            self._entries[key] = (hexdigest, now)
+            self._pending.append((key, now, hexdigest))
+
+    def claim(self, st):
+        """
+        Called after a lookup() miss.  Returns None if the caller should hash
+        the file (and then call release()), or an Event that is set once
+        another thread that is already hashing it has finished.
+        """
+        key = stat_key(st)
+        with self._lock:
+            event = self._inflight.get(key)
+            if event is not None:
+                return event
+            self._inflight[key] = threading.Event()
+            return None
+
+    def release(self, st):
+        with self._lock:
+            event = self._inflight.pop(stat_key(st), None)
+        if event is not None:
+            event.set()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        if not self.cachedir:
+            self._pending = []
+            return
+        data = ''.join(['%s %d %s\n' % rec for rec in self._pending])
+        _mkdir_p(self.cachedir)
+        with _Lock(self._path(_LOCK_NAME), fcntl.LOCK_EX):
+            fd = os.open(self._path(_LOG_NAME),
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                while data:
+                    n = os.write(fd, data)
+                    data = data[n:]
+            finally:
+                os.close(fd)
+        self._nrecords += len(self._pending)
+        if self._oldest is None:
+            self._oldest = self._pending[0][1]
+        self._pending = []
+        if self._nrecords > 2 * self.max_entries or self._expired():
+            self._evict()
+
+    def _expired(self):
+        # allow a grace of max_age / 2 so that a cache whose stamps are
+        # spread out is not compacted on every flush
+        return int(time.time()) - self._oldest > self.max_age + self.max_age // 2
+
+    def evict(self):
+        with self._lock:
+            if self.cachedir:
+                self._evict()
+
+    def _evict(self):
+        _mkdir_p(self.cachedir)
+        with _Lock(self._path(_LOCK_NAME), fcntl.LOCK_EX):
+            entries, nrecords, _ = self._read_log()
+            oldest = int(time.time()) - self.max_age
+            live = [(stamp, key, hexdigest)
+                    for key, (hexdigest, stamp) in entries.items()
+                    if stamp >= oldest]
+            live.sort(reverse=True)
+            del live[self.max_entries:]
+
+            tmp = self._path('%s.%d.tmp' % (_LOG_NAME, os.getpid()))
+            with open(tmp, 'w') as f:
+                for stamp, key, hexdigest in reversed(live):
+                    f.write('%s %d %s\n' % (key, stamp, hexdigest))
+            os.rename(tmp, self._path(_LOG_NAME))
+
+        self._entries = dict((key, (hexdigest, stamp))
+                for stamp, key, hexdigest in live)
+        self._nrecords = len(live)
+        self._oldest = min([stamp for stamp, _, _ in live]) if live else None
+
+def hash_file(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return (hexdigest, st), where st is the file's stat, or None if the file
+    changed while it was being read (and so the digest must not be cached).
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            digest.update(data)
+        if stat_key(os.fstat(f.fileno())) != stat_key(st):
+            st = None
+    return digest.hexdigest(), st
+
+def hash_files(paths, jobs=DEFAULT_JOBS, cache=None,
+        chunk_size=DEFAULT_CHUNK_SIZE, stats=None, file_stats=None):
+    """
+    Return a dict mapping each path in paths to its SHA-256 hexdigest.  If
+    stats is given, the files and bytes read, and the cache hits, are
+    counted against its 'hash' phase.  file_stats may map paths to stat
+    results that the caller already has, to save stat()ing them again.
+
+    Paths that name the same file -- through a hardlink or a symlink, or
+    spelled differently -- are hashed once.
+    """
+    # (st_dev, st_ino) -> the paths naming that file
+    aliases = {}
+    files = []
+    paths = set(paths)
+    for path in paths:
+        st = file_stats.get(path) if file_stats else None
+        if st is None:
+            st = os.stat(path)
+        ident = (st.st_dev, st.st_ino)
+        if ident in aliases:
+            aliases[ident].append(path)
+            continue
+        aliases[ident] = [path]
+        files.append((path, st))
+
+    results = {}
+    todo = []
+    claimed = []
+    waiting = []
+    for path, st in files:
+        if cache is not None:
+            hexdigest = cache.lookup(st)
+            if hexdigest is not None:
+                results[path] = hexdigest
+                continue
+            # another build in this process may be hashing the same file
+            event = cache.claim(st)
+            if event is not None:
+                waiting.append((path, st, event))
+                continue
+            claimed.append(st)
+        todo.append((st.st_size, path))
+
+    # largest first, so that a big file picked up last doesn't leave the
+    # other workers idle while it finishes
+    todo.sort(reverse=True)
+    if stats is not None:
+        stats.count('hash', 'files', len(todo))
+        stats.count('hash', 'bytes', sum(size for size, path in todo))
+        stats.count('hash', 'cache_hits', len(results))
+        stats.count('hash', 'aliases', len(paths) - len(files))
+    todo = [path for size, path in todo]
+
+    def work(path):
+        return path, hash_file(path, chunk_size)
+
+    try:
+        if jobs > 1 and len(todo) > 1:
+            pool = ThreadPool(min(jobs, len(todo)))
+            try:
+                done = list(pool.imap_unordered(work, todo))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            done = [work(path) for path in todo]
+
+        for path, (hexdigest, st) in done:
+            results[path] = hexdigest
+            if cache is not None and st is not None:
+                cache.store(st, hexdigest)
+    finally:
+        for st in claimed:
+            cache.release(st)
+
+    for path, st, event in waiting:
+        event.wait()
+        hexdigest = cache.lookup(st)
+        if hexdigest is None:
+            # the other thread failed, or saw the file change
+            hexdigest = hash_file(path, chunk_size)[0]
+        results[path] = hexdigest
+
+    for path, st in files:
+        for alias in aliases[(st.st_dev, st.st_ino)][1:]:
+            results[alias] = results[path]
+    return results
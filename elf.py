@@ -0,0 +1,204 @@
+"""
+A minimal ELF reader.
+
+Reads the ELF header, program headers and dynamic section of a file with
+struct, in a single pass and without forking readelf.  ELF32 and ELF64
+files of either byte order are read, as readelf does.  Results are
+memoized on the file's path and stat key, for the CACHE_MAX most recently
+read files, so that a long-lived watch or batch process does not keep the
+parse of every library it has ever resolved.
+"""
+
+import collections
+import os
+import struct
+import threading
+
+from checksums import stat_key
+
+_ELF_MAGIC = '\x7fELF'
+_ELFCLASS32 = 1
+_ELFCLASS64 = 2
+_ELFDATA2LSB = 1
+_ELFDATA2MSB = 2
+
+class _Layout:
+    """
+    The structs of one ELF class and byte order.  The fields of a program
+    header are unpacked in the ELF64 order, whatever the class.
+    """
+    def __init__(self, order, elfclass):
+        if elfclass == _ELFCLASS64:
+            self.ehdr = struct.Struct(order + '16sHHIQQQIHHHHHH')
+            self.phdr = struct.Struct(order + 'IIQQQQQQ')
+            self.shdr = struct.Struct(order + 'IIQQQQIIQQ')
+            self.dyn = struct.Struct(order + 'qQ')
+        else:
+            self.ehdr = struct.Struct(order + '16sHHIIIIIHHHHHH')
+            self.phdr = struct.Struct(order + 'IIIIIIII')
+            self.shdr = struct.Struct(order + 'IIIIIIIIII')
+            self.dyn = struct.Struct(order + 'iI')
+        self.elfclass = elfclass
+
+    def unpack_phdr(self, data, offset):
+        fields = self.phdr.unpack_from(data, offset)
+        if self.elfclass == _ELFCLASS64:
+            return fields
+        # Elf32_Phdr has p_flags after p_memsz
+        (p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags,
+                p_align) = fields
+        return (p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz,
+                p_memsz, p_align)
+
+_LAYOUTS = dict(((data, elfclass), _Layout(order, elfclass))
+                for data, order in ((_ELFDATA2LSB, '<'), (_ELFDATA2MSB, '>'))
+                for elfclass in (_ELFCLASS32, _ELFCLASS64))
+
+_PN_XNUM = 0xffff
+
+EM_X86_64 = 62
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+PF_X = 0x1
+PF_W = 0x2
+PF_R = 0x4
+
+# loadcmds is a list of (offset, addr, filesize, memsize, prot) tuples, one per
+# PT_LOAD segment, where prot is a mask of PF_R, PF_W and PF_X.  needed is the
+# list of DT_NEEDED names; interp, soname, rpath and runpath are None when
+# absent.
+ElfInfo = collections.namedtuple('ElfInfo', ['machine', 'entry', 'loadcmds',
+    'interp', 'needed', 'soname', 'rpath', 'runpath'])
+
+# Enough for the libraries and executables of a large batch.
+CACHE_MAX = 4096
+
+# path -> (stat key, ElfInfo), least recently used first
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+def _read_cstring(f, offset):
+    f.seek(offset)
+    s = ''
+    while True:
+        chunk = f.read(256)
+        if not chunk:
+            return s
+        nul = chunk.find('\0')
+        if nul != -1:
+            return s + chunk[:nul]
+        s += chunk
+
+def _vaddr_to_offset(loadcmds, vaddr):
+    for (offset, addr, filesize, memsize, prot) in loadcmds:
+        if addr <= vaddr < addr + filesize:
+            return offset + vaddr - addr
+    return None
+
+def _parse_dynamic(f, layout, loadcmds, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    strtab = None
+    entries = []
+    for i in range(len(data) // layout.dyn.size):
+        tag, val = layout.dyn.unpack_from(data, i * layout.dyn.size)
+        if tag == DT_NULL:
+            break
+        if tag == DT_STRTAB:
+            strtab = _vaddr_to_offset(loadcmds, val)
+        elif tag in (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH):
+            entries.append((tag, val))
+
+    dynamic = {DT_NEEDED: [], DT_SONAME: None, DT_RPATH: None, DT_RUNPATH: None}
+    if strtab is None:
+        return dynamic
+    for tag, val in entries:
+        s = _read_cstring(f, strtab + val)
+        if tag == DT_NEEDED:
+            dynamic[DT_NEEDED].append(s)
+        else:
+            dynamic[tag] = s
+    return dynamic
+
+def _parse(f):
+    ident = f.read(16)
+    if len(ident) < 16 or not ident.startswith(_ELF_MAGIC):
+        return None
+    layout = _LAYOUTS.get((ord(ident[5]), ord(ident[4])))
+    if layout is None:
+        raise ValueError('unsupported ELF class %d or data encoding %d' %
+                         (ord(ident[4]), ord(ident[5])))
+    ehdr = ident + f.read(layout.ehdr.size - 16)
+    if len(ehdr) < layout.ehdr.size:
+        raise ValueError('truncated ELF header')
+
+    (ident, e_type, e_machine, e_version, e_entry, e_phoff, e_shoff,
+            e_flags, e_ehsize, e_phentsize, e_phnum, e_shentsize, e_shnum,
+            e_shstrndx) = layout.ehdr.unpack(ehdr)
+
+    if e_phnum == _PN_XNUM and e_shoff:
+        # the real count doesn't fit; it is stored in section header 0
+        f.seek(e_shoff)
+        e_phnum = layout.shdr.unpack(f.read(layout.shdr.size))[7]
+
+    loadcmds = []
+    interp = None
+    dynamic = None
+    if e_phoff and e_phnum:
+        f.seek(e_phoff)
+        data = f.read(e_phentsize * e_phnum)
+        if len(data) < e_phentsize * e_phnum or \
+                e_phentsize < layout.phdr.size:
+            raise ValueError('truncated program header table')
+        for i in range(e_phnum):
+            (p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz,
+                    p_align) = layout.unpack_phdr(data, i * e_phentsize)
+            if p_type == PT_LOAD:
+                loadcmds.append((p_offset, p_vaddr, p_filesz, p_memsz,
+                                 p_flags & (PF_R | PF_W | PF_X)))
+            elif p_type == PT_INTERP:
+                interp = (p_offset, p_filesz)
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+
+    if interp is not None:
+        f.seek(interp[0])
+        interp = f.read(interp[1]).rstrip('\0')
+    if dynamic is not None:
+        dynamic = _parse_dynamic(f, layout, loadcmds, *dynamic)
+    else:
+        dynamic = {DT_NEEDED: [], DT_SONAME: None, DT_RPATH: None,
+                   DT_RUNPATH: None}
+
+    return ElfInfo(e_machine, e_entry, loadcmds, interp, dynamic[DT_NEEDED],
+                   dynamic[DT_SONAME], dynamic[DT_RPATH], dynamic[DT_RUNPATH])
+
+def read_elf(path):
+    """
+    Return the ElfInfo for path, or None if path is not an ELF file.  Raises
+    ValueError if it is one of a class or byte order this module cannot
+    read, or is truncated.
+    """
+    stamp = stat_key(os.stat(path))
+    with _cache_lock:
+        cached = _cache.pop(path, None)
+        if cached is not None and cached[0] == stamp:
+            _cache[path] = cached
+            return cached[1]
+    with open(path, 'rb') as f:
+        info = _parse(f)
+    with _cache_lock:
+        _cache[path] = (stamp, info)
+        while len(_cache) > CACHE_MAX:
+            _cache.popitem(last=False)
+    return info
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+import getopt
+import hashlib
+import hmac
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import aesm_pb2
+
+_USAGE = """
+fake_aesmd.py [options] SOCKET
+
+  A stand-in for Intel's aesmd, for testing and benchmarking
+  pal-sgx-get-token and make_sgx.py without SGX hardware.
+
+  Listens on the UNIX socket SOCKET and answers GetTokenReq messages
+  (aesm.proto) with a launch token built from the request: the token is
+  marked valid and carries the requested attributes, the MRENCLAVE, and
+  the MRSIGNER (the SHA-256 of the modulus), and a MAC that is a keyed
+  hash of these rather than one made by the launch enclave.  The same
+  request always gets the same token.  Several clients, and several
+  requests on one connection, are served.
+
+  options
+    -d, --delay SECONDS
+        Wait SECONDS before answering each request, to mimic the launch
+        enclave's latency.  Defaults to 0.
+
+    -e, --error CODE
+        Answer every request with error CODE instead of a token.
+
+    -h, --help
+        Show this help message and exit.
+
+    -v, --verbose
+        Log each request.
+
+  args
+    SOCKET
+        The path of the socket to listen on.  Point pal-sgx-get-token at
+        it with -socket, or make_sgx.py with --aesm-socket.
+""".strip()
+
+_MAC_KEY = 'fake_aesmd launch key'
+
+verbose = False
+
+def _usage(exitcode):
+    sys.stderr.write('%s\n' % _USAGE)
+    sys.exit(exitcode)
+
+def _log(tag, fmt, *args):
+    fmt = '[%s] %s' % (tag, fmt)
+    if not fmt.endswith('\n'):
+        fmt += '\n'
+    sys.stderr.write(fmt % args)
+
+def _debug(fmt, *args):
+    if not verbose:
+        return
+    _log('debug', fmt, *args)
+
+def _die(fmt, *args):
+    _log('die', fmt, *args)
+    sys.exit(1)
+
+def make_token(req):
+    """
+    Return the 304-byte EINITTOKEN for the GetTokenReqRaw req.
+    """
+    mrsigner = hashlib.sha256(req.key).digest()
+    body = struct.pack('<I44x16s32s32x32s32x', 1, req.attributes,
+                       req.signature, mrsigner)
+    # cpusvnle, isvprodidle, isvsvnle, maskedmiscselectle,
+    # maskedattributesle, keyid
+    body += struct.pack('<16xHH24xI16s32s', 0, 0, 0, req.attributes,
+                        hashlib.sha256(_MAC_KEY).digest())
+    mac = hmac.new(_MAC_KEY, body, hashlib.sha256).digest()[:16]
+    return body + mac
+
+class FakeAesmd:
+    def __init__(self, path, delay=0, error=0):
+        self.path = path
+        self.delay = delay
+        self.error = error
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def _recv_exact(self, conn, size):
+        chunks = []
+        while size > 0:
+            data = conn.recv(size)
+            if not data:
+                return None
+            chunks.append(data)
+            size -= len(data)
+        return ''.join(chunks)
+
+    def _serve(self, conn):
+        try:
+            while True:
+                header = self._recv_exact(conn, 4)
+                if header is None:
+                    return
+                req_msg = aesm_pb2.GetTokenReq()
+                req_msg.ParseFromString(self._recv_exact(conn,
+                        struct.unpack('<I', header)[0]))
+                with self._lock:
+                    self.requests += 1
+                _debug('token request for %s',
+                        req_msg.req.signature.encode('hex'))
+                if self.delay:
+                    time.sleep(self.delay)
+
+                ret_msg = aesm_pb2.GetTokenRet()
+                ret_msg.ret.error = self.error
+                if not self.error:
+                    ret_msg.ret.token = make_token(req_msg.req)
+                raw = ret_msg.SerializeToString()
+                conn.sendall(struct.pack('<I', len(raw)) + raw)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def listen(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(64)
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn, addr = self._sock.accept()
+            except socket.error:
+                # closed by stop()
+                return
+            with self._lock:
+                self.connections += 1
+            t = threading.Thread(target=self._serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def start(self):
+        """
+        Listen and serve from a background thread; for use in-process.
+        """
+        self.listen()
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        if self._sock is not None:
+            self._sock.shutdown(socket.SHUT_RDWR)
+            self._sock.close()
+            self._sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def main(argv):
+    shortopts = 'd:e:hv'
+    longopts = ['delay=', 'error=', 'help', 'verbose']
+    # options
+    global verbose
+    delay = 0
+    error = 0
+
+    try:
+        opts, args = getopt.getopt(argv[1:], shortopts, longopts)
+    except getopt.GetoptError as err:
+        sys.stderr.write('%s\n' % str(err))
+        _usage(1)
+
+    for o, a in opts:
+        if o in ('-d', '--delay'):
+            try:
+                delay = float(a)
+            except ValueError:
+                _die('--delay must be a number')
+        elif o in ('-e', '--error'):
+            try:
+                error = int(a)
+            except ValueError:
+                _die('--error must be an integer')
+        elif o in ('-h', '--help'):
+            _usage(0)
+        elif o in ('-v', '--verbose'):
+            verbose = True
+        else:
+            assert False, "unhandled option '%s'" % o
+
+    if len(args) != 1:
+        _usage(1)
+
+    server = FakeAesmd(args[0], delay, error)
+    server.listen()
+    _log('fake_aesmd', 'listening on %s', args[0])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,356 @@
+"""
+Resolve the shared-library dependencies of an ELF object without running ldd.
+
+DepResolver follows the ld.so search order (DT_RPATH of the loader chain,
+LD_LIBRARY_PATH, DT_RUNPATH, /etc/ld.so.cache, then the default directories)
+and walks DT_NEEDED breadth-first, so that it reports the same libraries, in
+the same order, as ldd.  Closures are memoized in memory and, when given a
+cache directory, on disk; a cached closure is reused only while every object
+and search directory it depended on is unchanged.
+"""
+
+import collections
+import errno
+import fcntl
+import json
+import os
+import struct
+import threading
+
+from checksums import _Lock, stat_key
+from elf import read_elf, EM_X86_64
+
+LD_SO_CACHE = '/etc/ld.so.cache'
+
+DEFAULT_LIB_DIRS = (
+    '/lib/x86_64-linux-gnu',
+    '/usr/lib/x86_64-linux-gnu',
+    '/lib64',
+    '/usr/lib64',
+    '/lib',
+    '/usr/lib',
+)
+
+_CACHE_NAME = 'libdeps.json'
+_LOCK_NAME = 'libdeps.lock'
+
+_LDSO_MAGIC_OLD = 'ld.so-1.7.0'
+_LDSO_MAGIC_NEW = 'glibc-ld.so.cache1.1'
+_LDSO_HDR_OLD = struct.Struct('<12sI')
+_LDSO_ENTRY_OLD = struct.Struct('<iII')
+_LDSO_HDR_NEW = struct.Struct('<20sII')
+_LDSO_HDR_NEW_SIZE = 48
+_LDSO_ENTRY_NEW = struct.Struct('<iIIIQ')
+
+# FLAG_ELF_LIBC6 | FLAG_X8664_LIB64
+_LDSO_FLAGS_X8664 = 0x0303
+
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _stat_key(path):
+    try:
+        return stat_key(os.stat(path))
+    except OSError:
+        return None
+
+def _cstring(data, offset):
+    end = data.find('\0', offset)
+    if end == -1:
+        return data[offset:]
+    return data[offset:end]
+
+def read_ld_so_cache(path=LD_SO_CACHE):
+    """
+    Return a dict mapping each x86-64 library name in the ld.so cache to its
+    path, or an empty dict if the cache is missing or unreadable.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return {}
+
+    base = 0
+    if data.startswith(_LDSO_MAGIC_OLD):
+        nlibs = _LDSO_HDR_OLD.unpack_from(data)[1]
+        base = _LDSO_HDR_OLD.size + nlibs * _LDSO_ENTRY_OLD.size
+        base = (base + 7) & ~7
+    if data[base:base + len(_LDSO_MAGIC_NEW)] != _LDSO_MAGIC_NEW:
+        return {}
+
+    magic, nlibs, len_strings = _LDSO_HDR_NEW.unpack_from(data, base)
+    libs = {}
+    for i in range(nlibs):
+        pos = base + _LDSO_HDR_NEW_SIZE + i * _LDSO_ENTRY_NEW.size
+        if pos + _LDSO_ENTRY_NEW.size > len(data):
+            break
+        flags, key, value, osversion, hwcap = \
+                _LDSO_ENTRY_NEW.unpack_from(data, pos)
+        if flags != _LDSO_FLAGS_X8664:
+            continue
+        name = _cstring(data, base + key)
+        # prefer the baseline entry over hwcap-specific variants
+        if name in libs and hwcap:
+            continue
+        libs[name] = _cstring(data, base + value)
+    return libs
+
+def _split_path(s, origin):
+    dirs = []
+    if not s:
+        return dirs
+    for d in s.split(':'):
+        if not d:
+            continue
+        d = d.replace('${ORIGIN}', origin).replace('$ORIGIN', origin)
+        dirs.append(d)
+    return dirs
+
+class _Object:
+    def __init__(self, name, path, info, loader):
+        self.name = name
+        self.path = path
+        self.info = info
+        self.loader = loader
+        origin = os.path.dirname(path)
+        self.rpath = _split_path(info.rpath, origin)
+        self.runpath = _split_path(info.runpath, origin)
+
+class DepResolver:
+    """
+    A resolver may be shared by several threads; resolutions are serialized,
+    so concurrent requests for the same closure compute it once.
+    """
+    def __init__(self, cachedir=None):
+        self.cachedir = cachedir
+        self._ld_so_cache = None
+        self._ld_so_cache_key = None
+        self._closures = {}
+        self._persisted = None
+        # keys of the closures resolved since the cache was last saved
+        self._dirty = set()
+        self._lock = threading.RLock()
+
+    #------------------------------------------------------
+    # ld.so search
+    #------------------------------------------------------
+
+    def _ld_cache(self):
+        # re-read the cache whenever ldconfig has replaced it
+        key = _stat_key(LD_SO_CACHE)
+        if self._ld_so_cache is None or key != self._ld_so_cache_key:
+            self._ld_so_cache = read_ld_so_cache()
+            self._ld_so_cache_key = key
+        return self._ld_so_cache
+
+    def _candidate(self, path, dirs_seen):
+        dirs_seen.add(os.path.dirname(path))
+        if not os.path.isfile(path):
+            return None
+        try:
+            info = read_elf(path)
+        except ValueError:
+            # ld.so passes over a file it cannot load
+            return None
+        if info is None or info.machine != EM_X86_64:
+            return None
+        return info
+
+    def _search(self, name, obj, dirs_seen):
+        if '/' in name:
+            info = self._candidate(name, dirs_seen)
+            return (name, info) if info else (None, None)
+
+        dirs = []
+        if not obj.runpath:
+            l = obj
+            while l is not None:
+                dirs.extend(l.rpath)
+                l = l.loader
+        dirs.extend(_split_path(os.environ.get('LD_LIBRARY_PATH'),
+                                os.path.dirname(obj.path)))
+        dirs.extend(obj.runpath)
+        for d in dirs:
+            path = os.path.join(d, name)
+            info = self._candidate(path, dirs_seen)
+            if info:
+                return path, info
+
+        path = self._ld_cache().get(name)
+        if path:
+            info = self._candidate(path, set())
+            if info:
+                return path, info
+
+        for d in DEFAULT_LIB_DIRS:
+            path = os.path.join(d, name)
+            info = self._candidate(path, dirs_seen)
+            if info:
+                return path, info
+        return None, None
+
+    def _resolve(self, path):
+        info = read_elf(path)
+        deps = collections.OrderedDict()
+        missing = []
+        inputs = set([path])
+        dirs_seen = set()
+        if info is None or info.machine != EM_X86_64:
+            return deps, missing, inputs, dirs_seen
+
+        root = _Object(None, os.path.abspath(path), info, None)
+        interp = os.path.basename(info.interp or 'ld-linux-x86-64.so.2')
+        seen_names = set([interp])
+        seen_files = set([_stat_key(path)])
+        queue = collections.deque([root])
+        while queue:
+            obj = queue.popleft()
+            for name in obj.info.needed:
+                if name in seen_names:
+                    continue
+                seen_names.add(name)
+                if os.path.basename(name) == interp:
+                    # the dynamic loader itself; ldd lists it without a path
+                    continue
+                libpath, libinfo = self._search(name, obj, dirs_seen)
+                if libpath is None:
+                    missing.append(name)
+                    continue
+                key = _stat_key(libpath)
+                if key in seen_files:
+                    continue
+                seen_files.add(key)
+                if libinfo.soname:
+                    seen_names.add(libinfo.soname)
+                inputs.add(libpath)
+                deps[name] = libpath
+                queue.append(_Object(name, libpath, libinfo, obj))
+        return deps, missing, inputs, dirs_seen
+
+    #------------------------------------------------------
+    # persistent cache
+    #------------------------------------------------------
+
+    def _cache_path(self):
+        return os.path.join(self.cachedir, _CACHE_NAME)
+
+    def _read_cache(self):
+        try:
+            with open(self._cache_path(), 'r') as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            # a corrupt cache is only a cache miss
+            pass
+        return {}
+
+    def _load(self):
+        self._persisted = {}
+        if self.cachedir:
+            self._persisted = self._read_cache()
+
+    def _closure_key(self, path):
+        self._ld_cache()
+        return '%s|%s|%s|%s' % (os.path.abspath(path), _stat_key(path),
+                self._ld_so_cache_key, os.environ.get('LD_LIBRARY_PATH', ''))
+
+    def _inputs_unchanged(self, entry):
+        for path, skey in entry['inputs']:
+            if _stat_key(path) != skey:
+                return False
+        return True
+
+    def _lookup_persisted(self, key):
+        if self._persisted is None:
+            self._load()
+        entry = self._persisted.get(key)
+        if entry is None or not self._inputs_unchanged(entry):
+            return None
+        # json hands back unicode; the rest of the tools deal in str
+        deps = collections.OrderedDict((name.encode('utf-8'), path.encode('utf-8'))
+                for name, path in entry['deps'])
+        return (deps, [name.encode('utf-8') for name in entry['missing']])
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if not self.cachedir or not self._dirty:
+            return
+        _mkdir_p(self.cachedir)
+        with _Lock(os.path.join(self.cachedir, _LOCK_NAME), fcntl.LOCK_EX):
+            # another job may have saved its own closures since we loaded
+            persisted = self._read_cache()
+            for key in self._dirty:
+                persisted[key] = self._persisted[key]
+            # drop closures of targets that have since changed
+            for key, entry in persisted.items():
+                path, skey = entry['target']
+                if _stat_key(path) != skey:
+                    del persisted[key]
+            tmp = '%s.%d.tmp' % (self._cache_path(), os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(persisted, f)
+            os.rename(tmp, self._cache_path())
+        self._persisted = persisted
+        self._dirty = set()
+
+    #------------------------------------------------------
+    # public api
+    #------------------------------------------------------
+
+    def resolve(self, path):
+        """
+        Return (deps, missing) for the ELF object at path: deps is an
+        OrderedDict mapping each DT_NEEDED name in the closure to the path
+        ld.so would load, in load order; missing lists the names that could
+        not be found.
+        """
+        with self._lock:
+            return self._resolve_memoized(path)
+
+    def _resolve_memoized(self, path):
+        key = self._closure_key(path)
+        memo = self._closures.get(key)
+        # a long-lived resolver must notice a library that was rebuilt
+        if memo is not None and key in self._persisted and \
+                self._inputs_unchanged(self._persisted[key]):
+            return memo
+
+        result = self._lookup_persisted(key)
+        if result is None:
+            deps, missing, inputs, dirs_seen = self._resolve(path)
+            result = (deps, missing)
+            self._persisted[key] = {
+                'target': [os.path.abspath(path), _stat_key(path)],
+                'deps': list(deps.items()),
+                'missing': missing,
+                'inputs': [[p, _stat_key(p)]
+                           for p in sorted(inputs | dirs_seen)],
+            }
+            self._dirty.add(key)
+
+        self._closures[key] = result
+        return result
+
+    def stamps(self, path):
+        """
+        Return the (path, stat key) pairs on which the closure of path
+        depends: the objects in it, the directories searched, and the ld.so
+        cache.  If none has changed, neither has the closure.
+        """
+        with self._lock:
+            key = self._closure_key(path)
+            if self._persisted is None or key not in self._persisted:
+                self._resolve_memoized(path)
+            entry = self._persisted[key]
+            return [(p, skey) for p, skey in entry['inputs']] + \
+                    [(LD_SO_CACHE, self._ld_so_cache_key)]
@@ -4,18 +4,33 @@ import binascii
 import collections
 import errno
 import getopt
+import json
 import os
 import re
-import subprocess
+import string
 import sys
 import urlparse
 
+from libdeps import DepResolver
+import manifests
+import pem
+from stats import Stats, NULL_STATS, profiled
+import treewalk
+
 _USAGE = """
 makemanifest.py [options] CONF
 
   Convert a configuration to a Graphene manifest.
 
   options
+    -c, --cache-dir PATH
+        A directory in which to cache shared-library dependency closures
+        across runs.
+
+    -f, --full
+        Translate every directive afresh, ignoring the record that the
+        last run left in OUTPUT.deps.
+
     -g, --graphene GRAPHENE_ROOT
         Path to the Graphene root directory.
 
@@ -25,6 +40,14 @@ makemanifest.py [options] CONF
     -o, --output OUTPUT
         The output manifest file
 
+    -P, --profile FILE
+        Run under cProfile and write the profile to FILE.
+
+    -s, --stats FILE
+        Write the wall and CPU time of each phase (directive parsing,
+        dependency resolution, the walk of read-only mounts, writing the
+        manifest) to FILE as JSON.
+
     -v, --verbose
         Verbose logging
 
@@ -32,10 +55,32 @@ makemanifest.py [options] CONF
     CONF
         The configuration file.  CONF is a simplified form of the
         graphene manifest.  CONF supports the following directives
+
+  Alongside OUTPUT, makemanifest.py keeps a record, OUTPUT.deps, of the
+  manifest lines each directive produced and the files, directories and
+  environment variables they depended on.  On the next run, a directive
+  whose text and inputs are unchanged is spliced in from the record rather
+  than redone; in particular, a read-only mount is not walked again unless
+  a directory in it has changed.  The manifest is the same either way.
 """.strip()
 
 _CONFIG_MAX = 4096
 
+# the record of the last run, next to the output manifest
+DEPS_SUFFIX = '.deps'
+# bumped whenever a change to this file changes what a directive emits, so
+# that an older record is not reused
+_DEPS_VERSION = 1
+
+# maps every byte that may not appear in a manifest key's tag to '_'
+_NAME_TABLE = ''.join(c if c in string.ascii_letters + string.digits + '_'
+                      else '_' for c in map(chr, range(256)))
+
+_ENV_REF = re.compile(r'\$(\w+)|\$\{(\w+)\}')
+
+# where make_sgx.py leaves an enclave's sigstruct in its output directory
+CHILD_SIGSTRUCT = 'manifest.sgx.sig'
+
 verbose = False
 
 def _usage(exitcode):
@@ -67,26 +112,81 @@ def _mkdir_p(path):
         if e.errno != errno.EEXIST:
             raise
 
+def _abs_path(path):
+    return os.path.abspath(os.path.expandvars(os.path.expanduser(path)))
+
+def _from_json(obj):
+    # json hands back unicode; the rest of the tools deal in str
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [_from_json(x) for x in obj]
+    if isinstance(obj, dict):
+        return dict((_from_json(k), _from_json(v)) for k, v in obj.iteritems())
+    return obj
+
+class ManifestError(Exception):
+    pass
+
+def _env_refs(text):
+    return set(m.group(1) or m.group(2) for m in _ENV_REF.finditer(text))
+
+def translation_context(inpath):
+    """
+    Return a sorted list of (name, value) strings for what translating the
+    pre-manifest inpath depends on besides files: the working directory,
+    against which relative paths resolve, and the environment variables
+    that it expands or that locate files.
+    """
+    with open(inpath) as f:
+        names = _env_refs(f.read())
+    names.update(('HOME', 'LD_LIBRARY_PATH'))
+    return [('cwd', os.getcwd())] + \
+           [('env.' + name, repr(os.environ.get(name)))
+            for name in sorted(names)]
+
+def child_enclaves(inpath):
+    """
+    Return the (pre-manifest, outdir) of each CHILD directive in the
+    pre-manifest inpath, as absolute paths, without translating it.
+    """
+    children = []
+    with open(inpath) as f:
+        for linenum, line in enumerate(f, 1):
+            args = line.split()
+            if not args or args[0] != 'CHILD':
+                continue
+            if len(args) != 3:
+                raise ManifestError('%s:%d directive "CHILD" takes 2 args, but %d given' %
+                        (inpath, linenum, len(args) - 1))
+            children.append((_abs_path(args[1]), _abs_path(args[2])))
+    return children
+
 # nargs = mimimum number of args needed; varargs is a boolean that is
 # true if additional args to the directive may be present.
 Directive = collections.namedtuple('Directive', ['fn', 'nargs', 'varargs'])
 
 class ManifestMaker:
-    def __init__(self, graphene, inpath, out_manifest):
+    def __init__(self, graphene, inpath, out_manifest, cachedir=None,
+            resolver=None, stats=None, incremental=True):
         self.graphene = os.path.abspath(graphene)
         self.inpath = inpath
         self.out_manifest = os.path.abspath(out_manifest)
         self.linenum = 0
+        # a resolver may be shared by several ManifestMakers
+        self.resolver = resolver or DepResolver(cachedir)
+        self.stats = stats or NULL_STATS
 
         self._directive_table = {
             'MOUNT':  Directive(self._mount_fn, 3, True),
             'DEBUG':  Directive(self._debug_fn, 1, False),
             'EXEC':   Directive(self._exec_fn, 1, False),
             'MODULE': Directive(self._module_fn, 1, False),
-            'ENCLAVE_SIZE': Directive(self._enclave_size_fn, 1, False),
+            'ENCLAVE_SIZE': Directive(self._enclave_size_fn, 1, True),
             'THREADS': Directive(self._threads_fn, 1, True),
             'TIMESERVER': Directive(self._timeserver_fn, 3, False),
             'CAFILE': Directive(self._cafile_fn, 1, False),
+            'CHILD': Directive(self._child_fn, 2, False),
         }
 
         self._uri_schemes = ('file', 'pipe', 'tcp', 'udp')
@@ -108,8 +208,30 @@ class ManifestMaker:
         self.libpaths = collections.OrderedDict()
         self.trusted_libs = collections.OrderedDict()
         self.ro_uris = []
+        # the treewalk.WalkPolicy of each of ro_uris
+        self.ro_policies = []
         self.rw_uris = []
         self.out = []
+        # host files whose contents the manifest depends on
+        self.inputs = [os.path.abspath(inpath)]
+        # path -> stat result, for the files found under ro_uris
+        self.file_stats = {}
+
+        # reuse the parts of the last run's record that are still valid
+        self.incremental = incremental
+        # each assignment to trusted_libs, as (name, path), in order
+        self._lib_log = []
+        # (path, stat key) pairs that directives depend on, besides inputs
+        self._stamps = []
+        # this run's record: one fragment per directive and one walk per
+        # read-only mount
+        self._fragments = []
+        self._walks = []
+        # the (line number, text) of each of _fragments' directives
+        self._directive_lines = []
+        # the last run's: directive text -> fragment, (root, policy) -> walk
+        self._old_fragments = {}
+        self._old_walks = {}
 
     #------------------------------------------------------
     # error checking / reporting
@@ -117,10 +239,7 @@ class ManifestMaker:
 
     def _parse_err(self, fmt, *args):
         ffmt = '%s:%d %s' % (self.inpath, self.linenum, fmt)
-        if not ffmt.endswith('\n'):
-            ffmt += '\n'
-        sys.stderr.write(ffmt % args)
-        sys.exit(1)
+        raise ManifestError(ffmt % args)
 
     def _check_uri(self, uri):
         pos = uri.find(':')
@@ -141,13 +260,13 @@ class ManifestMaker:
 
     def _check_fstype(self, fstype):
         if fstype not in self._fstypes:
-            self._parse_error('unrecognized fstype \"%s\"', fstype)
+            self._parse_err('unrecognized fstype \"%s\"', fstype)
 
     def _check_int(self, s):
         try:
             v = int(s)
         except ValueError:
-            self._parse_error('expected an integer value but got \"%s\"', s)
+            self._parse_err('expected an integer value but got \"%s\"', s)
         else:
             return v
 
@@ -155,19 +274,19 @@ class ManifestMaker:
         try:
             v = float(s)
         except ValueError:
-            self._parse_error('expected a float value but got \"%s\"', s)
+            self._parse_err('expected a float value but got \"%s\"', s)
         else:
             return v
 
     def _check_timeserver_url(self, url):
         p = urlparse.urlparse(url)
         if p.scheme != 'udp':
-            self._parse_error('invalid timeserver url: scheme must be "udp"')
+            self._parse_err('invalid timeserver url: scheme must be "udp"')
         if p.path or p.params or p.query or p.fragment:
-            self._parse_error('invalid timeserver url: found path/params/query/fragment')
+            self._parse_err('invalid timeserver url: found path/params/query/fragment')
         if p.port:
             if p.netloc != '%s:%d' % (p.hostname, p.port):
-                self._parse_error('invalid timeserver url: bad netloc')
+                self._parse_err('invalid timeserver url: bad netloc')
         # TODO test p.hostname matches regex for ipv4 address
 
     #------------------------------------------------------
@@ -175,7 +294,7 @@ class ManifestMaker:
     #------------------------------------------------------
 
     def _abs_path(self, path):
-        return os.path.abspath(os.path.expandvars(os.path.expanduser(path)))
+        return _abs_path(path)
 
     def _graphene_path(self, subpath):
         return os.path.join(self.graphene, subpath)
@@ -204,68 +323,43 @@ class ManifestMaker:
     def _out(self, manifest_directive):
         self.out.append(manifest_directive)
 
-    def _run_cmd(self, cmd):
-        _debug('running cmd: %s', cmd)
-        try:
-            output = subprocess.check_output(cmd, shell=True)
-        except subprocess.CalledProcessError as err:
-            _die("cmd '%s' returned %d: %s", cmd, err.returncode, str(err))
-        else:
-            return output
-
-    def _lstrip_00_bytes(self, a):
-        h = a[0]
-        while h == '00':
-            a.pop(0)
-            h = a[0]
-
     def _dump_pem_pubkey(self, pubfile):
-        cmd = 'openssl rsa -inform PEM -pubin -in %s -text -noout' % pubfile
-        self._run_cmd(cmd)
-        output = subprocess.check_output(cmd, shell=True)
-        lines = output.splitlines()
-
-        bits = 0
-        mod_hex = []
-        exp_hex = []
-
-        # XXX: really gross parsing of the openssl output
-        for i, line in enumerate(lines):
-            if re.match(r'\s+[\da-f]{2}:', line):
-                line = line.strip().rstrip(':')
-                mod_hex.extend(line.split(':'))
-            else: 
-                mobj = re.match(r'Exponent: \d+ \(0x([\da-f]+)\)', line)
-                if mobj:
-                    hs = mobj.group(1)
-                    if len(hs) % 2:
-                        hs = '0' + hs
-                    for i in xrange(0, len(hs), 2):
-                        exp_hex.append(hs[i:i+2])
-                    continue
-                mobj = re.match(r'Public-Key: \((\d+) bit\)', line)
-                if mobj:
-                    bits = int(mobj.group(1))
-
-        self._lstrip_00_bytes(mod_hex)
-        self._lstrip_00_bytes(exp_hex)
-
-        # TODO: error checking
-        return (mod_hex, exp_hex)
+        """
+        Return the hex of the modulus and exponent of the RSA public key in
+        pubfile.
+        """
+        try:
+            mod, exp = pem.read_rsa_public_key(pubfile)
+        except (IOError, OSError, pem.PemError) as err:
+            self._parse_err('%s: %s', pubfile, str(err))
+        return (binascii.hexlify(mod), binascii.hexlify(exp))
 
     def _cert_pem_to_der_buf(self, cert_pemfile):
-        cmd = 'openssl x509 -outform der -in %s' % cert_pemfile
-        output = self._run_cmd(cmd)
-        return output
-
+        try:
+            return pem.read_certificate(cert_pemfile)
+        except (IOError, OSError, pem.PemError) as err:
+            self._parse_err('%s: %s', cert_pemfile, str(err))
 
     def _add_trusted_depends(self, host_uri):
-        path = self._uri_path(host_uri)
-        cmd = 'ldd %s' % path
-        output = self._run_cmd(cmd)
-        for mobj in re.finditer(r'^\s*(.+) => (.+) \(0x[a-f0-9]+\)\s*$', 
-                output, re.MULTILINE):
-            self.trusted_libs[mobj.group(1)] = self._abs_path(mobj.group(2))
+        path = self._uri_to_abs_path(host_uri)
+        if not os.path.isfile(path):
+            self._parse_err('cannot find \"%s\"', path)
+        with self.stats.phase('ldd'):
+            try:
+                deps, missing = self.resolver.resolve(path)
+            except ValueError as err:
+                self._parse_err('%s: %s', path, str(err))
+        for name in missing:
+            _warn('%s: dependency \"%s\" not found', path, name)
+        self.inputs.append(path)
+        for name, libpath in deps.iteritems():
+            self._trust_lib(name, self._abs_path(libpath))
+            self.inputs.append(self.trusted_libs[name])
+        self._stamps.extend(self.resolver.stamps(path))
+
+    def _trust_lib(self, name, path):
+        self.trusted_libs[name] = path
+        self._lib_log.append((name, path))
 
     def _update_libpaths(self, host_uri, graphene_mntpoint):
         if self.libpaths.has_key(host_uri):
@@ -279,7 +373,7 @@ class ManifestMaker:
         The tags in a graphene key (e.g., tag1.tag2.tag3) can only consist of
         [a-zA-Z0-9_].  Thus, we change any invalid chars in name to _
         """
-        return re.sub(r'[^A-Za-z0-9_]', '_', name)
+        return name.translate(_NAME_TABLE)
 
     #------------------------------------------------------
     # directive handlers
@@ -296,16 +390,43 @@ class ManifestMaker:
         # special case for ro/rw option for chroot
         # for ro, must add to list of tursted files
         # for rw, must add mount to list of allowed files.
-        if len(options) != 1:
+        if len(options) < 1:
             self._parse_err('chroot mount: missing ro/rw option')
         opt = options[0]
         if opt not in ('ro', 'rw'):
             self._parse_err('chroot mount: invalid option \"%s\"', opt)
         if opt == 'ro':
             self.ro_uris.append(host_uri)
+            self.ro_policies.append(self._walk_policy(options[1:]))
         else:
+            if len(options) != 1:
+                self._parse_err('chroot mount: rw takes no options')
             self.rw_uris.append(host_uri)
 
+    def _walk_policy(self, options):
+        # ro options: include=GLOB[,GLOB...] exclude=GLOB[,GLOB...]
+        # symlinks=keep|follow|skip special=keep|skip|error empty=keep|skip
+        choices = {
+            'symlinks': treewalk.SYMLINK_POLICIES,
+            'special': treewalk.SPECIAL_POLICIES,
+            'empty': treewalk.EMPTY_POLICIES,
+        }
+        policy = treewalk.DEFAULT_POLICY._asdict()
+        for opt in options:
+            key, sep, val = opt.partition('=')
+            if not sep or not val:
+                self._parse_err('chroot mount: invalid option \"%s\"', opt)
+            if key in ('include', 'exclude'):
+                policy[key] += tuple(p for p in val.split(',') if p)
+            elif key in choices:
+                if val not in choices[key]:
+                    self._parse_err('chroot mount: %s must be one of %s, not \"%s\"',
+                            key, '|'.join(choices[key]), val)
+                policy[key] = val
+            else:
+                self._parse_err('chroot mount: unknown option \"%s\"', key)
+        return treewalk.WalkPolicy(**policy)
+
     def _mount_nextfs(self, host_uri, graphene_path, *options):
         self._mount_generic(host_uri, graphene_path, 'nextfs')
 
@@ -359,7 +480,7 @@ class ManifestMaker:
         try:
             mountfn = ftab[fstype]
         except KeyError:
-            self._parse_error('unrecognized fstype \"%s\"', fstype)
+            self._parse_err('unrecognized fstype \"%s\"', fstype)
         mountfn(host_uri, graphene_path, *options)
 
     def _debug_fn(self, onoff):
@@ -380,12 +501,24 @@ class ManifestMaker:
 
     def _module_fn(self, host_uri):
         name = os.path.basename(host_uri)
-        self.trusted_libs[name] = self._uri_to_abs_path(host_uri)
+        self._trust_lib(name, self._uri_to_abs_path(host_uri))
         self._add_trusted_depends(host_uri)
 
-    def _enclave_size_fn(self, mb):
-        v = self._check_int(mb)
-        self._out('sgx.enclave_size = %dM' % v)
+    def _enclave_size_fn(self, mb, *options):
+        if mb != 'auto':
+            if options:
+                self._parse_err('ENCLAVE_SIZE: options are only valid with "auto"')
+            v = self._check_int(mb)
+            self._out('sgx.enclave_size = %dM' % v)
+            return
+        # pal-sgx-sign picks the size once it has laid out the enclave
+        value = 'auto'
+        for option in options:
+            if not option.startswith('heap='):
+                self._parse_err('ENCLAVE_SIZE: invalid option "%s"', option)
+            heap = self._check_int(option[len('heap='):])
+            value = 'auto heap=%dM' % heap
+        self._out('sgx.enclave_size = %s' % value)
 
     def _threads_fn(self, num, *options):
         v = self._check_int(num)
@@ -401,23 +534,33 @@ class ManifestMaker:
     def _timeserver_fn(self, url, pubkey_file, rate):
         #self._check_timeserver_url(url)
         mod_hex, exp_hex = self._dump_pem_pubkey(pubkey_file)
+        self.inputs.append(self._abs_path(pubkey_file))
         r = self._check_float(rate)
         if r > 1 or r < 0:
-            self._parse_error('TIMESERVER: invalid rate: %f; must be >= 0 and <= 1', r)
+            self._parse_err('TIMESERVER: invalid rate: %f; must be >= 0 and <= 1', r)
         r = int(r * 10000)
         self._out('timeserver.url = %s' % url);
-        self._out('timeserver.rsa_n = %s' % ''.join(mod_hex))
-        self._out('timeserver.rsa_e = %s' % ''.join(exp_hex))
+        self._out('timeserver.rsa_n = %s' % mod_hex)
+        self._out('timeserver.rsa_e = %s' % exp_hex)
         self._out('timeserver.rate = %d' % r)
         
     def _cafile_fn(self, cafile_pem):
         der = self._cert_pem_to_der_buf(cafile_pem)
+        self.inputs.append(self._abs_path(cafile_pem))
         der_hex = binascii.hexlify(der)
         if len(der_hex) > _CONFIG_MAX:
             self._parse_err('cafile_pem \"%s\": conversion to der hex is too big (%d)',
-                    len(der_hex))
+                    cafile_pem, len(der_hex))
         self._out('phoenix.ca_der = %s' % der_hex)
 
+    def _child_fn(self, premanifest, outdir):
+        # make_sgx.py packages the child into outdir first, and pal-sgx-sign
+        # takes its MRENCLAVE from the sigstruct there
+        outdir = self._abs_path(outdir)
+        name = self._make_name(os.path.basename(outdir))
+        self._out('sgx.trusted_children.%s = file:%s' % (name,
+                os.path.join(outdir, CHILD_SIGSTRUCT)))
+
     #------------------------------------------------------
     # Post processing steps
     #------------------------------------------------------
@@ -440,14 +583,48 @@ class ManifestMaker:
 
     def _postprocess_ro_uris(self):
         fmt = 'sgx.trusted_files.%s = %s'
-        for uri in self.ro_uris:
-            root = self._uri_path(uri)
-            for dirpath, dirnames, filenames in os.walk(root):
-                for fname in filenames:
-                    fullpath = os.path.join(dirpath, fname)
-                    name = self._make_name(fullpath)
-                    uri = 'file:' + fullpath
-                    self._out(fmt % (name, uri))
+        trees = [(self._uri_path(uri), policy)
+                 for uri, policy in zip(self.ro_uris, self.ro_policies)]
+        # a tree that the last run walked, and whose directories are
+        # unchanged, holds the same files
+        walked = [None] * len(trees)
+        todo = []
+        for i, tree in enumerate(trees):
+            walk = self._old_walks.get(tree)
+            if walk is not None and treewalk.stamps_unchanged(walk['stamps']):
+                walked[i] = [(path, None) for path in
+                             walk['files'].split('\0') if path]
+                self._walks.append(walk)
+                self.stats.count('ro_walk', 'reused')
+            else:
+                todo.append(i)
+
+        skipped = []
+        stamps = []
+        try:
+            fresh = treewalk.walk_trees([trees[i] for i in todo],
+                    skipped=skipped, stamps=stamps)
+        except treewalk.WalkError as err:
+            raise ManifestError(str(err))
+        for path in skipped:
+            _debug('ro mount: skipping \"%s\"', path)
+        self.stats.count('ro_walk', 'skipped', len(skipped))
+        for i, files, tree_stamps in zip(todo, fresh, stamps):
+            walked[i] = files
+            root, policy = trees[i]
+            # one string rather than a list, which json reads far faster
+            self._walks.append({'root': root, 'policy': policy,
+                    'files': '\0'.join(path for path, st in files),
+                    'stamps': tree_stamps})
+
+        for files in walked:
+            self.stats.count('ro_walk', 'files', len(files))
+            for fullpath, st in files:
+                name = self._make_name(fullpath)
+                uri = 'file:' + fullpath
+                self._out(fmt % (name, uri))
+                if st is not None:
+                    self.file_stats[os.path.normpath(fullpath)] = st
 
     def _postprocess_rw_uris(self):
         fmt = 'sgx.allowed_files.%s = %s'
@@ -485,7 +662,8 @@ class ManifestMaker:
     def _postprocess(self):
         self._postprocess_trusted_libs()
         self._postprocess_rw_uris()
-        self._postprocess_ro_uris()
+        with self.stats.phase('ro_walk'):
+            self._postprocess_ro_uris()
         self._add_lib_mounts()
         self._add_loader_cmds()
         #self._out('sgx.debug = 1')
@@ -495,11 +673,7 @@ class ManifestMaker:
         line = '#!%s SGX\n' % loader_path
         return line
 
-    #------------------------------------------------------
-    # public api
-    #------------------------------------------------------
-
-    def make(self):
+    def _read_directives(self):
         with open(self.inpath) as f:
             for line in f.readlines():
                 self.linenum += 1
@@ -520,24 +694,207 @@ class ManifestMaker:
                     if nargs < directive.nargs:
                         self._parse_err('directive \"%s\" needs at least %d args, but only %d given',
                                 name, directive.nargs, nargs)
-                directive.fn(*args)  
+                self._run_directive(line, directive.fn, args)
+
+    #------------------------------------------------------
+    # incremental translation
+    #------------------------------------------------------
+
+    def _context(self):
+        # what every directive may depend on; a record made in a different
+        # context is not used
+        return {
+            'version': _DEPS_VERSION,
+            'graphene': self.graphene,
+            'cwd': os.getcwd(),
+            'HOME': os.environ.get('HOME'),
+            'LD_LIBRARY_PATH': os.environ.get('LD_LIBRARY_PATH'),
+        }
+
+    def _record(self, text, fn, args):
+        """
+        Run the directive and return its fragment: what it added to the
+        translation, and the (path, stat key) stamps of what it read.
+        """
+        env = dict((name, os.environ.get(name))
+                   for name in _env_refs(text))
+        nout, nlibs, nro, nrw, ninputs, nstamps = (len(self.out),
+                len(self._lib_log), len(self.ro_uris), len(self.rw_uris),
+                len(self.inputs), len(self._stamps))
+        fn(*args)
+
+        stamps = self._stamps[nstamps:]
+        seen = set(path for path, key in stamps)
+        for path in self.inputs[ninputs:]:
+            if path not in seen:
+                seen.add(path)
+                stamps.append((path, treewalk.stamp(path)))
+        return {
+            'text': text,
+            'env': env,
+            'out': self.out[nout:],
+            'libs': self._lib_log[nlibs:],
+            'ro': zip(self.ro_uris[nro:], self.ro_policies[nro:]),
+            'rw': self.rw_uris[nrw:],
+            'inputs': self.inputs[ninputs:],
+            'stamps': stamps,
+        }
+
+    def _replay(self, frag):
+        self.out.extend(frag['out'])
+        for name, path in frag['libs']:
+            self._trust_lib(name, path)
+        for uri, policy in frag['ro']:
+            self.ro_uris.append(uri)
+            self.ro_policies.append(policy)
+        self.rw_uris.extend(frag['rw'])
+        self.inputs.extend(frag['inputs'])
+
+    def _fragment_unchanged(self, frag):
+        for name, value in frag['env'].iteritems():
+            if os.environ.get(name) != value:
+                return False
+        return treewalk.stamps_unchanged(frag['stamps'])
+
+    def _run_directive(self, text, fn, args):
+        frag = self._old_fragments.get(text)
+        if frag is not None and self._fragment_unchanged(frag):
+            self._replay(frag)
+            self.stats.count('directives', 'reused')
+        else:
+            frag = self._record(text, fn, args)
+        self._fragments.append(frag)
+        self._directive_lines.append((self.linenum, text))
+
+    def _deps_path(self):
+        return self.out_manifest + DEPS_SUFFIX
+
+    def _load_record(self):
+        try:
+            with open(self._deps_path(), 'r') as f:
+                record = _from_json(json.load(f))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        except ValueError:
+            # a corrupt record only means translating everything
+            return
+        if record.get('context') != self._context():
+            return
+
+        def policy(p):
+            return treewalk.WalkPolicy(tuple(p[0]), tuple(p[1]), *p[2:])
+
+        for frag in record['directives']:
+            frag['ro'] = [(uri, policy(p)) for uri, p in frag['ro']]
+            self._old_fragments[frag['text']] = frag
+        for walk in record['walks']:
+            walk['policy'] = policy(walk['policy'])
+            self._old_walks[(walk['root'], walk['policy'])] = walk
+
+    def _save_record(self):
+        record = {
+            'context': self._context(),
+            'directives': self._fragments,
+            'walks': self._walks,
+        }
+        path = self._deps_path()
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(record))
+        os.rename(tmp, path)
+
+    #------------------------------------------------------
+    # public api
+    #------------------------------------------------------
+
+    def make(self):
+        """
+        Translate the premanifest and write the manifest.  Returns the
+        manifest in memory, as a manifests.Manifest, so that it can be
+        handed to pal-sgx-sign's sign() without re-reading the file.
+        Raises ManifestError on a bad premanifest.
+        """
+        if self.incremental:
+            self._load_record()
+        with self.stats.phase('directives'):
+            self._read_directives()
 
         self._postprocess()
         self.out.sort()
 
-        _mkdir_p(os.path.dirname(self.out_manifest))
-        with open(self.out_manifest, 'wb') as f:
-            f.write(self._shebang_line())
-            for line in self.out:
-                f.write(line + '\n')
+        # The lines are written as they are; the Manifest is only for
+        # lookups, and would fold a key given twice into one line.
+        manifest = manifests.Manifest()
+        manifest.add_line(self._shebang_line())
+        for line in self.out:
+            manifest.add_line(line)
+
+        with self.stats.phase('write_manifest'):
+            _mkdir_p(os.path.dirname(self.out_manifest))
+            with open(self.out_manifest, 'wb') as f:
+                f.write(self._shebang_line())
+                for line in self.out:
+                    f.write(line + '\n')
+            self._save_record()
+
+            self.resolver.save()
+        return manifest
+
+    def stamps(self):
+        """
+        After make(), return the (path, stat key) pairs other than inputs
+        that the translation depended on: chiefly the directories searched
+        for shared libraries and the ld.so cache, which change when a
+        library that would be found first is added.
+        """
+        inputs = set(self.inputs)
+        stamps = {}
+        for frag in self._fragments:
+            for path, key in frag['stamps']:
+                path = os.path.abspath(path)
+                if path not in inputs:
+                    stamps[path] = key
+        return sorted(stamps.iteritems())
+
+    def key_sources(self):
+        """
+        After make(), return a dict mapping each manifest key that a
+        directive gave rise to, to the (line number, text) of the directive.
+        The keys that only post-processing adds -- the library mounts and
+        the loader settings -- are absent.
+        """
+        walks = dict(((walk['root'], walk['policy']), walk['files'])
+                     for walk in self._walks)
+        sources = {}
+        for where, frag in zip(self._directive_lines, self._fragments):
+            keys = [line.split('=', 1)[0].strip() for line in frag['out']]
+            keys.extend('sgx.trusted_files.' + self._make_name(name)
+                        for name, path in frag['libs'])
+            keys.extend('sgx.allowed_files.' +
+                        self._make_name(self._uri_path(uri))
+                        for uri in frag['rw'])
+            for uri, policy in frag['ro']:
+                files = walks.get((self._uri_path(uri), policy), '')
+                keys.extend('sgx.trusted_files.' + self._make_name(path)
+                            for path in files.split('\0') if path)
+            for key in keys:
+                sources[key] = where
+        return sources
 
 def main(argv):
-    shortopts = 'hg:o:v'
-    longopts = ['help', 'graphene=', 'output=', 'verbose']
+    shortopts = 'c:fhg:o:P:s:v'
+    longopts = ['cache-dir=', 'full', 'help', 'graphene=', 'output=',
+            'profile=', 'stats=', 'verbose']
     # options
     global verbose
+    cachedir = None
+    full = False
     out_manifest = None
     graphene = '/usr/src/graphene'
+    profile = None
+    statsfile = None
     # arguments
     conf = None
 
@@ -548,12 +905,20 @@ def main(argv):
         _usage(1)
 
     for o, a in opts:
-        if o in ('-h', '--help'):
+        if o in ('-c', '--cache-dir'):
+            cachedir = a
+        elif o in ('-f', '--full'):
+            full = True
+        elif o in ('-h', '--help'):
             _usage(0)
         elif o in ('-g', '--graphene'):
             graphene = a
         elif o in ('-o', '--output'):
             out_manifest = a
+        elif o in ('-P', '--profile'):
+            profile = a
+        elif o in ('-s', '--stats'):
+            statsfile = a
         elif o in ('-v', '--verbose'):
             verbose = True
         else:
@@ -566,7 +931,16 @@ def main(argv):
     if not out_manifest:
         out_manifest = '%s.manifest.sgx' % conf
 
-    ManifestMaker(graphene, conf, out_manifest).make()
+    stats = statsfile and Stats() or None
+    try:
+        with profiled(profile):
+            ManifestMaker(graphene, conf, out_manifest, cachedir,
+                    stats=stats, incremental=not full).make()
+    except ManifestError as err:
+        sys.stderr.write('%s\n' % str(err))
+        sys.exit(1)
+    if stats:
+        stats.write(statsfile)
 
 if __name__ == '__main__':
     main(sys.argv)
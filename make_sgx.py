@@ -1,9 +1,19 @@
 #!/usr/bin/env python
 
 import getopt
+import imp
+import multiprocessing
 import os
+import Queue
 import subprocess
 import sys
+import tempfile
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from buildcache import BuildCache, base_key
+from stats import Stats, NULL_STATS, profiled, load as load_stats
+from watch import make_watcher, PollWatcher, MODIFIED, DEFAULT_DEBOUNCE
 
 _USAGE = """
 make_sgx.py [options]
@@ -16,6 +26,57 @@ invokes pal-sgx-sign to sign the enclave image, and finall invokeds
 pal-sgx-get-token to retrieve a launch token.
 
   options:
+    -a, --aesm-socket PATH
+        Ask the aesmd listening on the UNIX socket PATH for launch tokens,
+        rather than the system's aesmd; e.g. a fake_aesmd.py.
+
+    -b, --build-plan PLAN
+        Package many enclaves in one run.  Each non-comment line of PLAN
+        names a pre-manifest and an output directory:
+
+            # pre-manifest                  outdir
+            fileserver/manifest.conf        deploy/nextfsserver
+            smuf/client/manifest.conf       deploy/smufclient
+
+        ~ and $VARs in the paths are expanded, and relative paths are
+        relative to the directory of PLAN.  The
+        targets are packaged in-process (see --in-process) on a pool of
+        --workers threads and share their caches of file digests, ELF
+        headers and shared-library dependencies.  A target that fails
+        does not stop the others; the exit status is non-zero if any
+        target failed.  The launch tokens of all the targets are fetched
+        at the end, over a single aesmd connection.
+
+        The child enclaves that a pre-manifest declares with CHILD
+        directives, and theirs, are packaged too, whether or not PLAN
+        lists them: each target is packaged once its children are, and
+        not at all if one of them failed.  A pre-manifest given with
+        --pre-manifest that declares children is packaged this way as
+        well.
+
+    -c, --cache-dir PATH
+        A directory in which make_manifest.py caches shared-library
+        dependencies, pal-sgx-sign caches the checksums of trusted
+        files, and pal-sgx-get-token caches launch tokens across runs.
+        The directory may be shared by concurrent builds.
+
+        With --in-process or --build-plan, the directory also caches
+        whole builds: if the pre-manifest, the key, libpal, the tools,
+        every file the last build of it read, the working directory and
+        the environment it was translated in are unchanged, the manifest,
+        manifest.sgx and sigstruct are copied from the cache instead of
+        being rebuilt.
+
+    -E, --token-max-age SECONDS
+        How long a cached launch token is used before aesmd is asked for
+        a new one.  Defaults to a day.
+
+    -f, --force
+        Rebuild even if the build cache has the outputs, and have
+        make_manifest.py translate every directive afresh rather than
+        reuse what its record of the last run (OUTDIR/manifest.deps)
+        says is unchanged.
+
     -g, --graphene GRAPHENE_PATH
         Mandatory.
         The path to the graphene root directory
@@ -23,6 +84,16 @@ pal-sgx-get-token to retrieve a launch token.
     -h, --help
         Display this message and exit.
 
+    -i, --in-process
+        Run make_manifest.py, pal-sgx-sign and pal-sgx-get-token as
+        library code inside this process, handing the manifest from one
+        stage to the next in memory, rather than as separate programs
+        that communicate through files.
+
+    -j, --jobs N
+        The number of threads pal-sgx-sign uses to hash trusted files.
+        Defaults to the number of CPUs.
+
     -k, --key SIGNING_KEY
         Mandatory.
         The private key for signing an enclave image.
@@ -30,6 +101,10 @@ pal-sgx-get-token to retrieve a launch token.
     -m, --manifest GRAPHENE_MANIFST
         A graphene .manifest file
 
+    -n, --no-token-cache
+        Always ask aesmd for the launch token, even if --cache-dir has
+        one for the same enclave and signer.
+
     -o, --outdir PATH
         The output directory in which to place the manifest.sgx file
         and launch token.
@@ -41,18 +116,68 @@ pal-sgx-get-token to retrieve a launch token.
         A simplified version of a graphene manifest -- what I call
         a pre-manifest
 
+    -P, --profile FILE
+        Run under cProfile and write the profile to FILE.  Without
+        --in-process, make_manifest.py and pal-sgx-sign write theirs to
+        FILE.make_manifest and FILE.pal-sgx-sign.
+
+    -q, --quiet
+        Have pal-sgx-sign omit the per-file listing of trusted files and
+        memory areas, which is slow to print for large images.
+
+    -s, --stats FILE
+        Write the wall and CPU time of each stage and phase, with counters
+        such as the bytes and files hashed per second and the pages
+        EADDed and EEXTENDed, to FILE as JSON.
+
+    -T, --token-timeout SECONDS
+        How long aesmd may take to produce a launch token, and how long
+        to wait for its reply before retrying.  Defaults to 10.
+
     -t, --tool-dir PATH
         The directory that has the tools:
             - make_manifest.py
             - pal-sgx-sign
             - pal-sgx-get-token
         
-        If not given, the tools are assumed to be on the user's $PATH.
+        If not given, the tools are assumed to be on the user's $PATH
+        (or, with --in-process, in the directory of make_sgx.py).
 
     -v, --verbose
         Enable verbose logging.
+
+    -w, --workers N
+        With --build-plan, the number of targets to package at once.
+        Defaults to the number of CPUs.
+
+    -W, --watch
+        After packaging, keep running and re-package whenever the
+        pre-manifest or one of the enclave's inputs changes: the EXEC
+        and MODULE files and their libraries, the files under the
+        'MOUNT ... chroot ro' trees, libpal and the signing key.  Only
+        the stages a change affects are re-run: an edit to a trusted
+        file is re-signed, while an edit to the pre-manifest or to an
+        executable, or a file added to or removed from a read-only
+        tree, also regenerates the manifest.  A burst of writes triggers
+        a single rebuild.  Uses inotify where available and polling
+        otherwise.  Implies --in-process, so the caches of file
+        digests, ELF headers and dependencies stay warm between builds.
+        Requires --pre-manifest.
+
+  environment:
+    SOURCE_DATE_EPOCH
+        If set, pal-sgx-sign stamps the sigstruct with the date of this
+        time (seconds since the epoch) rather than today's, so that a
+        rebuild of the same inputs is byte for byte the same.
 """.strip()
 
+# what the build cache stores of a build
+_CACHED_OUTPUTS = ('manifest', 'manifest.sgx', 'manifest.sgx.sig')
+
+# the tools' sources, a change to which invalidates the build cache
+_TOOL_SOURCES = ('make_manifest.py', 'pal-sgx-sign', 'checksums.py', 'elf.py',
+        'libdeps.py', 'manifests.py', 'pem.py', 'treewalk.py')
+
 verbose = False
 
 def _usage(exitcode):
@@ -77,19 +202,69 @@ def _die(fmt, *args):
     _log('die', fmt, *args)
     sys.exit(1)
 
+class MakeError(Exception):
+    pass
+
 def _run_cmd(cmd):
     _debug('running cmd: %s', cmd)
     try:
         subprocess.check_call(cmd, shell=True)
     except subprocess.CalledProcessError as err:
-        _die("cmd '%s' returned %d: %s", cmd, err.returncode, str(err)) 
+        raise MakeError("cmd '%s' returned %d: %s" %
+                (cmd, err.returncode, str(err)))
 
 class Maker:
-    def __init__(self, graphene, outdir, tooldir=None, verbose=False):
+    def __init__(self, graphene, outdir, tooldir=None, verbose=False,
+            cachedir=None, jobs=None, inprocess=False):
         self.graphene = graphene
         self.outdir = outdir
         self.tooldir = tooldir
         self.verbose = verbose
+        self.cachedir = cachedir
+        self.jobs = jobs
+        self.inprocess = inprocess
+        # in-process pipeline state
+        self.manifest = None
+        self.sigstruct = None
+        # caches shared by the targets of a batch build
+        self.resolver = None
+        self.checksum_cache = None
+        # the last in-process ManifestMaker, for --watch
+        self.manifest_maker = None
+        self.file_stats = None
+        self.stats = None
+        self.profile = None
+        self.quiet = False
+        # the aesmd to ask for launch tokens, None for the system's
+        self.aesm_socket = None
+        self.token_timeout = None
+        # in-process, one connection to aesmd serves all the tokens
+        self.aesm_client = None
+        self.token_max_age = None
+        self.no_token_cache = False
+        # --force: rebuild rather than restore from the build cache, and
+        # translate the whole premanifest
+        self.force = False
+        self.build_cache = None
+        # when the last translation started reading its inputs
+        self.build_started = None
+
+    def _stats(self):
+        return self.stats or NULL_STATS
+
+    def _stats_tmpfile(self):
+        fd, path = tempfile.mkstemp(prefix='make_sgx-stats.')
+        os.close(fd)
+        return path
+
+    def _merge_stats(self, path):
+        try:
+            self.stats.merge(load_stats(path))
+        except (IOError, ValueError) as err:
+            _warn('cannot read stats from %s: %s', path, str(err))
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
 
     def _executable_path(self, name):
         if self.tooldir:
@@ -103,36 +278,183 @@ class Maker:
         else:
             return name
 
+    def _load_tool(self, name):
+        # the tools are scripts, and some lack a .py suffix, so load them
+        # by path rather than with import
+        modname = name.replace('-', '_')
+        if modname.endswith('.py'):
+            modname = modname[:-3]
+        if modname in sys.modules:
+            return sys.modules[modname]
+        tooldir = self.tooldir or os.path.dirname(os.path.abspath(__file__))
+        if tooldir not in sys.path:
+            sys.path.insert(0, tooldir)
+        _debug('loading tool %s', os.path.join(tooldir, name))
+        return imp.load_source(modname, os.path.join(tooldir, name))
+
+    def _libpal_path(self):
+        return os.path.join(self.graphene, 'Runtime', 'libpal-Linux-SGX.so')
+
     def make_manifest(self, premanifest):
+        if self.inprocess and self.cachedir:
+            self.build_started = self._build_cache().clock()
+        with self._stats().phase('make_manifest'):
+            self._make_manifest(premanifest)
+
+    def _make_manifest(self, premanifest):
+        if self.inprocess:
+            tool = self._load_tool('make_manifest.py')
+            tool.verbose = self.verbose
+            maker = tool.ManifestMaker(self.graphene, premanifest,
+                    self._out_path('manifest'), self.cachedir, self.resolver,
+                    self.stats, not self.force)
+            self.manifest_maker = maker
+            self.manifest = maker.make()
+            self.file_stats = maker.file_stats
+            return
+
+        statsfile = None
         args = []
         args.append('--graphene %s' % self.graphene)
         args.append('--output %s' % self._out_path('manifest'))
+        if self.cachedir:
+            args.append('--cache-dir %s' % self.cachedir)
+        if self.force:
+            args.append('--full')
         if self.verbose:
             args.append('--verbose')
+        if self.stats:
+            statsfile = self._stats_tmpfile()
+            args.append('--stats %s' % statsfile)
+        if self.profile:
+            args.append('--profile %s.make_manifest' % self.profile)
         args.append(premanifest)
         executable = self._executable_path('make_manifest.py')
         cmd = '%s %s' % (executable, ' '.join(args))
         _run_cmd(cmd)
+        if statsfile:
+            self._merge_stats(statsfile)
+
+    def _sign_in_process(self, keyfile):
+        tool = self._load_tool('pal-sgx-sign')
+        args = {
+            'output': self._out_path('manifest.sgx'),
+            'key': keyfile,
+            'libpal': self._libpal_path(),
+        }
+        if self.cachedir:
+            args['cache'] = self.cachedir
+        if self.jobs:
+            args['jobs'] = self.jobs
+        if self.checksum_cache is not None:
+            args['checksum_cache'] = self.checksum_cache
+        if self.stats:
+            args['stats'] = self.stats
+        args['quiet'] = self.quiet
+        if self.file_stats is not None:
+            # the stat()s make_manifest just made of the ro-mount files;
+            # they go stale, so they are used for one signing only
+            args['file_stats'] = self.file_stats
+            self.file_stats = None
+        if self.manifest is None:
+            args['manifest'] = self._out_path('manifest')
+            self.manifest = tool.read_manifest(args['manifest'])[0]
+        # signing adds sgx.sigfile, the checksums and any auto enclave size
+        # to the manifest it is given; keep self.manifest as translated so
+        # that a watch rebuild that only re-signs starts from scratch
+        manifest = self.manifest.copy()
+        self.sigstruct = tool.sign(manifest, manifest.layout, args)
 
     def sign_manifest(self, keyfile):
+        with self._stats().phase('sign_manifest'):
+            self._sign_manifest(keyfile)
+
+    def _sign_manifest(self, keyfile):
         manifest = self._out_path('manifest')
         manifest_sgx = self._out_path('manifest.sgx')
-        libpal = os.path.join(self.graphene, 'Runtime', 'libpal-Linux-SGX.so')
+        libpal = self._libpal_path()
+
+        if self.inprocess:
+            self._sign_in_process(keyfile)
+            os.chmod(manifest_sgx, 0775)
+            return
 
         args = []
         args.append('-output %s' % manifest_sgx)
         args.append('-key %s' % keyfile)
         args.append('-libpal %s' % libpal)
         args.append('-manifest %s' % manifest)
+        if self.cachedir:
+            args.append('-cache %s' % self.cachedir)
+        if self.jobs:
+            args.append('-jobs %d' % self.jobs)
+        statsfile = None
+        if self.stats:
+            statsfile = self._stats_tmpfile()
+            args.append('-stats %s' % statsfile)
+        if self.profile:
+            args.append('-profile %s.pal-sgx-sign' % self.profile)
+        if self.quiet:
+            args.append('-quiet')
         executable = self._executable_path('pal-sgx-sign')
         cmd = '%s %s' % (executable, ' '.join(args))
         _run_cmd(cmd)
+        if statsfile:
+            self._merge_stats(statsfile)
         os.chmod(manifest_sgx, 0775) 
 
     def get_token(self):
+        with self._stats().phase('token'):
+            self._get_token()
+
+    def _aesm(self):
+        if self.aesm_client is None:
+            tool = self._load_tool('pal-sgx-get-token')
+            self.aesm_client = tool.AesmClient(self.aesm_socket,
+                    self.token_timeout or tool.DEFAULT_TIMEOUT)
+        return self.aesm_client
+
+    def _token_cache(self):
+        if not self.cachedir or self.no_token_cache:
+            return None
+        tool = self._load_tool('pal-sgx-get-token')
+        return tool.TokenCache(self.cachedir,
+                self.token_max_age or tool.DEFAULT_TOKEN_MAX_AGE)
+
+    def _sigstruct_attrs(self):
+        tool = self._load_tool('pal-sgx-get-token')
+        if self.sigstruct is None:
+            with open(self._out_path('manifest.sgx.sig'), 'rb') as f:
+                self.sigstruct = f.read()
+        return tool.read_sigstruct(str(self.sigstruct))
+
+    def _write_token(self, token):
+        with open(self._out_path('manifest.sgx.token'), 'wb') as f:
+            f.write(token)
+
+    def _get_token(self):
+        if self.inprocess:
+            tool = self._load_tool('pal-sgx-get-token')
+            error, token = tool.get_tokens(self._aesm(),
+                    [self._sigstruct_attrs()], self._token_cache())[0]
+            if error != 0:
+                raise tool.AesmError(error)
+            self._write_token(token)
+            return
+
         args = []
         args.append('-output %s' % self._out_path('manifest.sgx.token'))
         args.append('-sig %s' % self._out_path('manifest.sgx.sig'))
+        if self.aesm_socket:
+            args.append('-socket %s' % self.aesm_socket)
+        if self.token_timeout:
+            args.append('-timeout %s' % self.token_timeout)
+        if self.cachedir:
+            args.append('-cache %s' % self.cachedir)
+        if self.token_max_age:
+            args.append('-max-age %d' % self.token_max_age)
+        if self.no_token_cache:
+            args.append('-no-cache')
         executable = self._executable_path('pal-sgx-get-token')
         cmd = '%s %s' % (executable, ' '.join(args))
         _run_cmd(cmd)
@@ -145,17 +467,414 @@ class Maker:
                     os.path.basename(self.outdir))
             os.rename(self._out_path('manifest.sgx'), new_name)
 
+    #------------------------------------------------------
+    # build cache
+    #------------------------------------------------------
+
+    def _build_cache(self):
+        if self.build_cache is None:
+            if self.checksum_cache is None:
+                tool = self._load_tool('pal-sgx-sign')
+                self.checksum_cache = tool.ChecksumCache(self.cachedir)
+            self.build_cache = BuildCache(self.cachedir, self.checksum_cache,
+                    self.jobs or multiprocessing.cpu_count())
+        return self.build_cache
+
+    def _build_key(self, premanifest, keyfile):
+        tool = self._load_tool('pal-sgx-sign')
+        offsets = sys.modules['generated_offsets']
+        # relative paths in the premanifest resolve against the working
+        # directory, and $VARs in it expand, when it is translated
+        context = self._load_tool('make_manifest.py').translation_context(
+                premanifest)
+        return base_key(context + [
+            ('premanifest', os.path.abspath(premanifest)),
+            ('graphene', os.path.abspath(self.graphene)),
+            ('key', os.path.abspath(keyfile)),
+            ('offsets', repr(sorted((name, value)
+                    for name, value in vars(offsets).iteritems()
+                    if not name.startswith('_')))),
+            ('date', tool.build_date().isoformat()),
+        ])
+
+    def _tool_sources(self):
+        tooldir = self.tooldir or os.path.dirname(os.path.abspath(__file__))
+        return [os.path.join(tooldir, name) for name in _TOOL_SOURCES]
+
+    def restore_build(self, premanifest, keyfile):
+        """
+        If the build cache has the outputs of an earlier build with the same
+        inputs, copy them to the output directory and return True.
+        """
+        if not self.inprocess or not self.cachedir or self.force:
+            return False
+        stats = self._stats()
+        with stats.phase('build_cache'):
+            cache = self._build_cache()
+            path = cache.lookup(self._build_key(premanifest, keyfile),
+                    _CACHED_OUTPUTS)
+            if path is None:
+                stats.count('build_cache', 'misses')
+                return False
+            cache.restore(path, dict((name, self._out_path(name))
+                                     for name in _CACHED_OUTPUTS))
+            stats.count('build_cache', 'hits')
+        _debug('restored %s from the build cache', premanifest)
+        self.manifest = None
+        self.sigstruct = None
+        return True
+
+    def save_build(self, premanifest, keyfile):
+        if not self.inprocess or not self.cachedir:
+            return
+        with self._stats().phase('build_cache'):
+            manifest_inputs, trees, sign_inputs = self._watch_set(keyfile)
+            inputs = manifest_inputs | sign_inputs
+            inputs.update(self._tool_sources())
+            stamped = [path for path, key in self.manifest_maker.stamps()]
+            cache = self._build_cache()
+            cache.store(self._build_key(premanifest, keyfile), inputs,
+                    trees, dict((name, self._out_path(name))
+                                for name in _CACHED_OUTPUTS), stamped,
+                    self.build_started)
+            self.checksum_cache.flush()
+
+    #------------------------------------------------------
+    # watch mode
+    #------------------------------------------------------
+
+    def _build(self, premanifest, keyfile, remanifest=True):
+        if remanifest:
+            self.make_manifest(premanifest)
+        self.sign_manifest(keyfile)
+        self.get_token()
+        self.finalize()
+
+    def _watch_set(self, keyfile):
+        """
+        Return (manifest_inputs, trees, sign_inputs): the files whose change
+        means regenerating the manifest, the read-only trees, and the files
+        whose change only means re-signing.
+        """
+        maker = self.manifest_maker
+        manifest_inputs = set(maker.inputs)
+        trees = set(os.path.abspath(uri[len('file:'):])
+                    for uri in maker.ro_uris)
+        sign_inputs = set([os.path.abspath(keyfile), self._libpal_path()])
+        if self.manifest is not None:
+            for key, uri in self.manifest.prefixed('sgx.trusted_children.'):
+                if uri.startswith('file:'):
+                    sig = os.path.abspath(uri[len('file:'):])
+                    if not sig.endswith('.sig'):
+                        sig += '.sig'
+                    sign_inputs.add(sig)
+            uris = [val for key, val in
+                    self.manifest.prefixed('sgx.trusted_files.')]
+            for key in ('loader.exec', 'loader.preload'):
+                if key in self.manifest:
+                    uris.append(self.manifest[key])
+            for uri in uris:
+                if uri.startswith('file:'):
+                    sign_inputs.add(os.path.abspath(uri[len('file:'):]))
+        return manifest_inputs, trees, sign_inputs - manifest_inputs
+
+    def _needs_manifest(self, changes, manifest_inputs, trees):
+        for path, kind in changes:
+            if path in manifest_inputs:
+                return True
+            if kind != MODIFIED:
+                for root in trees:
+                    if path == root or path.startswith(root.rstrip('/') + '/'):
+                        return True
+        return False
+
+    def watch(self, premanifest, keyfile, debounce=DEFAULT_DEBOUNCE):
+        """
+        Package, then re-package on every change to the inputs, forever.
+        """
+        self.inprocess = True
+        if self.resolver is None:
+            self.resolver = self._load_tool('make_manifest.py').DepResolver(
+                    self.cachedir)
+        if self.checksum_cache is None:
+            self.checksum_cache = self._load_tool('pal-sgx-sign').ChecksumCache(
+                    self.cachedir)
+
+        watcher = make_watcher()
+        remanifest = True
+        while True:
+            failed = False
+            try:
+                self._build(premanifest, keyfile, remanifest)
+            except Exception as err:
+                if self.verbose:
+                    traceback.print_exc()
+                _warn('%s', str(err))
+                # the manifest on hand may be from an older translation
+                failed = True
+            self.checksum_cache.flush()
+
+            manifest_inputs, trees, sign_inputs = self._watch_set(keyfile)
+            files = manifest_inputs | sign_inputs
+            try:
+                watcher.update(files, trees)
+            except OSError as err:
+                _warn('%s; falling back to polling', str(err))
+                watcher.close()
+                watcher = PollWatcher()
+                watcher.update(files, trees)
+            _log('watch', 'watching %d files and %d trees', len(files),
+                    len(trees))
+
+            changes = watcher.wait(debounce)
+            for path, kind in changes:
+                _debug('%s %s', kind, path)
+            remanifest = failed or \
+                    self._needs_manifest(changes, manifest_inputs, trees)
+            _log('watch', '%d changes; re-running %s', len(changes),
+                    remanifest and 'all stages' or 'signing')
+
+def _read_build_plan(path):
+    plandir = os.path.dirname(os.path.abspath(path))
+    targets = []
+    with open(path) as f:
+        for linenum, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                _die('%s:%d expected "PRE_MANIFEST OUTDIR"', path, linenum)
+            # expanded as make_manifest.py expands CHILD paths, but relative
+            # to the plan
+            premanifest, outdir = [os.path.normpath(os.path.join(plandir,
+                    os.path.expandvars(os.path.expanduser(p))))
+                    for p in fields]
+            targets.append((premanifest, outdir))
+    return targets
+
+def _plan_children(targets, child_enclaves):
+    """
+    Return (targets, children): targets with the child enclaves that their
+    pre-manifests' CHILD directives declare, transitively, added after
+    them, and for each target the set of indexes of its children.
+    child_enclaves is make_manifest.py's.  A target is known by its output
+    directory; raises MakeError if two pre-manifests share one, or if a
+    target is its own descendant.
+    """
+    planned = targets
+    targets = []
+    index = {}
+    for premanifest, outdir in planned:
+        key = os.path.abspath(outdir or os.curdir)
+        j = index.setdefault(key, len(targets))
+        if j == len(targets):
+            targets.append((premanifest, outdir))
+        elif os.path.abspath(targets[j][0]) != os.path.abspath(premanifest):
+            raise MakeError('%s: %s is also the output of %s' %
+                    (premanifest, key, targets[j][0]))
+    children = []
+    i = 0
+    while i < len(targets):
+        premanifest, outdir = targets[i]
+        deps = set()
+        for child in child_enclaves(premanifest):
+            j = index.setdefault(child[1], len(targets))
+            if j == len(targets):
+                targets.append(child)
+            elif os.path.abspath(targets[j][0]) != child[0]:
+                raise MakeError('%s: %s is also the output of %s' %
+                        (premanifest, child[1], targets[j][0]))
+            deps.add(j)
+        children.append(deps)
+        i += 1
+
+    # depth-first, to find a cycle
+    state = [0] * len(targets)      # 0 unseen, 1 in progress, 2 done
+    def visit(i):
+        state[i] = 1
+        for j in children[i]:
+            if state[j] == 1:
+                raise MakeError('%s: CHILD %s is one of its ancestors' %
+                        (targets[i][0], targets[j][0]))
+            if state[j] == 0:
+                visit(j)
+        state[i] = 2
+    for i in range(len(targets)):
+        if state[i] == 0:
+            visit(i)
+    return targets, children
+
+def make_batch(targets, graphene, keyfile, tooldir=None, cachedir=None,
+        jobs=None, workers=None, stats=None, quiet=False, aesm_socket=None,
+        token_timeout=None, token_max_age=None, no_token_cache=False,
+        force=False, profile=None):
+    """
+    Package each (premanifest, outdir) in targets, and the child enclaves
+    their CHILD directives declare, workers at a time, with shared caches.
+    A child is packaged before its parents, whose sigstructs carry its
+    MRENCLAVE, and a parent one of whose children failed is not packaged.
+    With profile, the caller is running under cProfile, which sees only its
+    own thread, so the targets are packaged one at a time on that thread.
+    Returns a list of (premanifest, outdir, error) for the targets that
+    failed.
+    """
+    # Load the tools, and build the shared caches, before any worker runs.
+    proto = Maker(graphene, None, tooldir, verbose, cachedir, jobs, True)
+    proto.aesm_socket = aesm_socket
+    proto.token_timeout = token_timeout
+    proto.token_max_age = token_max_age
+    proto.no_token_cache = no_token_cache
+    manifest_tool = proto._load_tool('make_manifest.py')
+    resolver = manifest_tool.DepResolver(cachedir)
+    checksum_cache = proto._load_tool('pal-sgx-sign').ChecksumCache(cachedir)
+    token_tool = proto._load_tool('pal-sgx-get-token')
+    aesm = proto._aesm()
+
+    def build(target):
+        premanifest, outdir = target
+        maker = Maker(graphene, outdir, tooldir, verbose, cachedir, jobs, True)
+        maker.resolver = resolver
+        maker.checksum_cache = checksum_cache
+        maker.stats = stats
+        maker.quiet = quiet
+        maker.force = force
+        try:
+            if not maker.restore_build(premanifest, keyfile):
+                maker.make_manifest(premanifest)
+                maker.sign_manifest(keyfile)
+                maker.save_build(premanifest, keyfile)
+            return maker, maker._sigstruct_attrs(), None
+        except Exception as err:
+            if verbose:
+                traceback.print_exc()
+            _warn('%s: %s', premanifest, str(err))
+            return maker, None, err
+
+    try:
+        targets, children = _plan_children(targets,
+                manifest_tool.child_enclaves)
+    except (IOError, manifest_tool.ManifestError) as err:
+        raise MakeError(str(err))
+    parents = [[] for target in targets]
+    for i, deps in enumerate(children):
+        for j in deps:
+            parents[j].append(i)
+
+    # Run each target once its children are done, so that independent ones
+    # are packaged side by side.
+    results = [None] * len(targets)
+    waiting = [len(deps) for deps in children]
+    done = Queue.Queue()
+    pool = None
+    if not profile:
+        pool = ThreadPool(max(1, min(workers or multiprocessing.cpu_count(),
+                                     len(targets))))
+
+    def run(i):
+        # Always post a result for i, or the loop below waits forever.
+        result = (None, None, MakeError('worker failed'))
+        try:
+            result = build(targets[i])
+        except BaseException as err:
+            _warn('%s: %s', targets[i][0], str(err))
+            result = (None, None, err)
+            raise
+        finally:
+            done.put((i, result))
+
+    try:
+        def submit(i):
+            if pool is None:
+                run(i)
+            else:
+                pool.apply_async(run, (i,))
+        for i in range(len(targets)):
+            if waiting[i] == 0:
+                submit(i)
+        remaining = len(targets)
+        while remaining:
+            i, result = done.get()
+            results[i] = result
+            remaining -= 1
+            for p in parents[i]:
+                waiting[p] -= 1
+                if result[2] is not None and results[p] is None:
+                    err = MakeError('child %s failed' % targets[i][0])
+                    _warn('%s: %s', targets[p][0], str(err))
+                    results[p] = (None, None, err)
+                    done.put((p, results[p]))
+                elif waiting[p] == 0 and results[p] is None:
+                    submit(p)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    resolver.save()
+    checksum_cache.flush()
+
+    # Fetch the tokens at the end, pipelined over one connection, rather
+    # than have each worker wait on aesmd in turn.  Cached tokens are not
+    # fetched at all.
+    errors = [err for maker, attrs, err in results]
+    signed = [i for i, err in enumerate(errors) if err is None]
+    try:
+        with (stats or NULL_STATS).phase('token'):
+            replies = token_tool.get_tokens(aesm,
+                    [results[i][1] for i in signed], proto._token_cache())
+    except Exception as err:
+        _warn('cannot get launch tokens: %s', str(err))
+        for i in signed:
+            errors[i] = err
+        replies = []
+    finally:
+        aesm.close()
+
+    for i, (error, token) in zip(signed, replies):
+        maker = results[i][0]
+        try:
+            if error != 0:
+                raise token_tool.AesmError(error)
+            maker._write_token(token)
+            maker.finalize()
+        except Exception as err:
+            if verbose:
+                traceback.print_exc()
+            _warn('%s: %s', targets[i][0], str(err))
+            errors[i] = err
+            continue
+        _debug('packaged %s into %s', targets[i][0], targets[i][1])
+
+    return [(premanifest, outdir, err)
+            for (premanifest, outdir), err in zip(targets, errors)
+            if err is not None]
+
 def main(argv):
-    shortopts = 'g:hk:m:o:p:t:v'
-    longopts = ['graphene=', 'help', 'key=', 'manifest=', 'outdir=',
-            'pre-manifest=','tool-dir=', 'verbose']
+    shortopts = 'a:b:c:E:fg:hij:k:m:no:p:P:qs:t:T:vw:W'
+    longopts = ['aesm-socket=', 'build-plan=', 'cache-dir=', 'force', 'graphene=', 'help', 'in-process', 'jobs=', 'key=', 'manifest=',
+            'no-token-cache', 'outdir=', 'token-max-age=',
+            'pre-manifest=', 'profile=', 'quiet', 'stats=', 'tool-dir=', 'token-timeout=', 'verbose', 'workers=', 'watch']
     # options
+    aesm_socket = None
+    buildplan = None
+    cachedir = None
+    force = False
     graphene = None
+    inprocess = False
+    jobs = None
     keyfile = None
     manifest = None
     outdir = None
     premanifest = None
+    profile = None
+    quiet = False
+    statsfile = None
+    no_token_cache = False
+    token_max_age = None
+    token_timeout = None
     tooldir = None
+    watch = False
+    workers = None
     global verbose
 
     try:
@@ -165,22 +884,66 @@ def main(argv):
         _usage(1)
 
     for o, a in opts:
-        if o in ('-g', '--graphene'):
+        if o in ('-a', '--aesm-socket'):
+            aesm_socket = a
+        elif o in ('-b', '--build-plan'):
+            buildplan = a
+        elif o in ('-c', '--cache-dir'):
+            cachedir = a
+        elif o in ('-E', '--token-max-age'):
+            try:
+                token_max_age = int(a)
+            except ValueError:
+                sys.stderr.write('error: --token-max-age must be an integer\n')
+                _usage(1)
+        elif o in ('-f', '--force'):
+            force = True
+        elif o in ('-g', '--graphene'):
             graphene = a
         elif o in ('-h', '--help'):
             _usage(0)
+        elif o in ('-i', '--in-process'):
+            inprocess = True
+        elif o in ('-j', '--jobs'):
+            try:
+                jobs = int(a)
+            except ValueError:
+                sys.stderr.write('error: --jobs must be an integer\n')
+                _usage(1)
         elif o in ('-k', '--key'):
             keyfile = a
         elif o in ('-m', '--manifest'):
             manifest = a
+        elif o in ('-n', '--no-token-cache'):
+            no_token_cache = True
         elif o in ('-o', '--outdir'):
             outdir = a
         elif o in ('-p', '--pre-manifest'):
             premanifest = a
+        elif o in ('-P', '--profile'):
+            profile = a
+        elif o in ('-q', '--quiet'):
+            quiet = True
+        elif o in ('-s', '--stats'):
+            statsfile = a
         elif o in ('-t', '--tool-dir'):
             tooldir = a
+        elif o in ('-T', '--token-timeout'):
+            try:
+                token_timeout = float(a)
+            except ValueError:
+                sys.stderr.write('error: --token-timeout must be a number\n')
+                _usage(1)
         elif o in ('-v', '--verbose'):
             verbose = True
+        elif o in ('-w', '--workers'):
+            try:
+                workers = int(a)
+            except ValueError:
+                sys.stderr.write('error: --workers must be an integer\n')
+                _usage(1)
+        elif o in ('-W', '--watch'):
+            watch = True
         else:
             assert False, "unhandled option '%s'" % o
 
@@ -192,11 +955,85 @@ def main(argv):
         sys.stderr.write('error: --key must be specified\n')
         _usage(1)
 
-    maker = Maker(graphene, outdir, tooldir, verbose)
-    maker.make_manifest(premanifest)
-    maker.sign_manifest(keyfile)
-    maker.get_token()
+    if watch and not premanifest:
+        sys.stderr.write('error: --watch requires --pre-manifest\n')
+        _usage(1)
+
+    stats = statsfile and Stats() or None
+    with profiled(profile):
+        failed = _make(graphene, keyfile, premanifest, outdir, tooldir,
+                cachedir, jobs, inprocess, buildplan, workers, watch, stats,
+                profile, quiet, aesm_socket, token_timeout, token_max_age,
+                no_token_cache, force)
+    if stats:
+        stats.write(statsfile)
+    if failed:
+        _die('%s', failed)
+
+def _make(graphene, keyfile, premanifest, outdir, tooldir, cachedir, jobs,
+        inprocess, buildplan, workers, watch, stats, profile, quiet,
+        aesm_socket, token_timeout, token_max_age, no_token_cache, force):
+    # Returns an error message, or None on success.
+    if watch:
+        maker = Maker(graphene, outdir, tooldir, verbose, cachedir, jobs, True)
+        maker.stats = stats
+        maker.quiet = quiet
+        maker.aesm_socket = aesm_socket
+        maker.token_timeout = token_timeout
+        maker.token_max_age = token_max_age
+        maker.no_token_cache = no_token_cache
+        try:
+            maker.watch(premanifest, keyfile)
+        except KeyboardInterrupt:
+            pass
+        return None
+
+    maker = Maker(graphene, outdir, tooldir, verbose, cachedir, jobs,
+            inprocess)
+    targets = None
+    if buildplan:
+        targets = _read_build_plan(buildplan)
+    elif premanifest:
+        # an enclave with children is packaged as a batch, to order them
+        tool = maker._load_tool('make_manifest.py')
+        try:
+            if tool.child_enclaves(premanifest):
+                targets = [(premanifest, outdir)]
+        except (IOError, tool.ManifestError) as err:
+            return str(err)
+    if targets is not None:
+        try:
+            failed = make_batch(targets, graphene, keyfile, tooldir, cachedir,
+                    jobs, workers, stats, quiet, aesm_socket, token_timeout,
+                    token_max_age, no_token_cache, force, profile)
+        except MakeError as err:
+            return str(err)
+        for premanifest, outdir, err in failed:
+            _warn('failed: %s -> %s', premanifest, outdir)
+        if failed:
+            return '%d targets failed' % len(failed)
+        return None
+
+    maker.stats = stats
+    maker.profile = profile
+    maker.quiet = quiet
+    maker.aesm_socket = aesm_socket
+    maker.token_timeout = token_timeout
+    maker.token_max_age = token_max_age
+    maker.no_token_cache = no_token_cache
+    maker.force = force
+    try:
+        if not maker.restore_build(premanifest, keyfile):
+            maker.make_manifest(premanifest)
+            maker.sign_manifest(keyfile)
+            maker.save_build(premanifest, keyfile)
+        maker.get_token()
+    except Exception as err:
+        if verbose:
+            traceback.print_exc()
+        return str(err)
     maker.finalize()
-    
+    return None
+
 if __name__ == '__main__':
     main(sys.argv)
@@ -0,0 +1,96 @@
+"""
+An in-memory Graphene manifest that keeps the layout of the file it was
+read from.
+
+A Manifest is a dict of key -> value, so lookups and updates are O(1), plus
+a layout: one (key, comment) pair per line of the source file, with key
+None for a line without a 'key = value' and comment None for a line without
+a '#'.  write() reproduces the source lines in order, with the current
+value of each key, and then appends the keys that are not in the layout
+(those added since reading) in sorted order.  This is the format that
+pal-sgx-sign has always read and written, so a manifest round-trips byte
+for byte as long as its lines are in 'key = value # comment' form.
+
+Reading and writing both stream a line at a time, so neither holds a second
+copy of a large manifest.
+"""
+
+class Manifest(dict):
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.layout = []
+
+    def add_line(self, line):
+        pound = line.find('#')
+        if pound != -1:
+            comment = line[pound:].strip()
+            line = line[:pound]
+        else:
+            comment = None
+
+        equal = line.find('=')
+        if equal != -1:
+            key = line[:equal].strip()
+            self[key] = line[equal + 1:].strip()
+        else:
+            key = None
+        self.layout.append((key, comment))
+
+    def copy(self):
+        manifest = Manifest(self)
+        manifest.layout = list(self.layout)
+        return manifest
+
+    def prefixed(self, prefix):
+        """
+        Return a sorted list of (suffix, value) for the keys that start
+        with prefix, e.g. prefixed('sgx.trusted_files.').
+        """
+        n = len(prefix)
+        return sorted((key[n:], val) for key, val in self.iteritems()
+                      if key.startswith(prefix))
+
+    def write(self, f, trailer=None):
+        write(f, self, self.layout, trailer)
+
+def read(lines):
+    """
+    Return the Manifest for lines, which may be an open file.
+    """
+    manifest = Manifest()
+    for line in lines:
+        manifest.add_line(line)
+    return manifest
+
+def load(path):
+    with open(path, 'r') as f:
+        return read(f)
+
+def write(f, values, layout, trailer=None):
+    """
+    Write the manifest given by the dict values and the layout to the file
+    f.  The lines of trailer, if any, are written between the laid-out keys
+    and the remaining ones.
+    """
+    listed = set()
+
+    def lines():
+        for key, comment in layout:
+            line = ''
+            if key is not None and key in values:
+                line = key + ' = ' + values[key]
+                listed.add(key)
+            if comment is not None:
+                if line != '':
+                    line += ' '
+                line += comment
+            yield line + '\n'
+
+        for line in trailer or ():
+            yield line + '\n'
+
+        for key in sorted(values):
+            if key not in listed:
+                yield key + ' = ' + values[key] + '\n'
+
+    f.writelines(lines())
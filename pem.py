@@ -0,0 +1,151 @@
+"""
+A minimal reader for PEM files: RSA public keys and X.509 certificates.
+
+Decodes the base64 body of a PEM block and walks its DER encoding with a
+small ASN.1 reader, without forking openssl.  Results are memoized on the
+file's path, size and mtime.
+"""
+
+import binascii
+import os
+
+_TAG_INTEGER = 0x02
+_TAG_BIT_STRING = 0x03
+_TAG_OID = 0x06
+_TAG_SEQUENCE = 0x30
+
+# DER of the rsaEncryption OID, 1.2.840.113549.1.1.1
+_RSA_ENCRYPTION = '\x2a\x86\x48\x86\xf7\x0d\x01\x01\x01'
+
+_CERT_LABELS = ('CERTIFICATE', 'X509 CERTIFICATE')
+
+_cache = {}
+
+class PemError(Exception):
+    pass
+
+def _read_tlv(data, offset):
+    """
+    Return (tag, start, end) for the DER element at offset: its tag and the
+    bounds of its contents.
+    """
+    if offset + 2 > len(data):
+        raise PemError('truncated DER element')
+    tag = ord(data[offset])
+    length = ord(data[offset + 1])
+    start = offset + 2
+    if length & 0x80:
+        nbytes = length & 0x7f
+        if nbytes == 0 or nbytes > 4 or start + nbytes > len(data):
+            raise PemError('bad DER length')
+        length = 0
+        for c in data[start:start + nbytes]:
+            length = (length << 8) | ord(c)
+        start += nbytes
+    end = start + length
+    if end > len(data):
+        raise PemError('truncated DER element')
+    return tag, start, end
+
+def _expect(data, offset, tag):
+    t, start, end = _read_tlv(data, offset)
+    if t != tag:
+        raise PemError('expected DER tag 0x%02x, found 0x%02x' % (tag, t))
+    return start, end
+
+def _pem_blocks(text):
+    """
+    Yield (label, der) for each PEM block in text.
+    """
+    label = None
+    body = []
+    for line in text.splitlines():
+        line = line.strip()
+        if label is None:
+            if line.startswith('-----BEGIN ') and line.endswith('-----'):
+                label = line[len('-----BEGIN '):-len('-----')]
+                body = []
+        elif line == '-----END %s-----' % label:
+            try:
+                der = binascii.a2b_base64(''.join(body))
+            except binascii.Error as e:
+                raise PemError('bad base64 in %s block: %s' % (label, e))
+            yield label, der
+            label = None
+        elif ':' not in line:
+            # skip RFC 1421 headers such as Proc-Type
+            body.append(line)
+    if label is not None:
+        raise PemError('unterminated %s block' % label)
+
+def _find_block(text, labels):
+    for label, der in _pem_blocks(text):
+        if label in labels:
+            return label, der
+    raise PemError('no %s block' % ' or '.join(labels))
+
+def _unsigned(data, start, end):
+    # INTEGER contents are two's complement; drop the sign byte, as well as
+    # any other leading zeros
+    value = data[start:end].lstrip('\0')
+    if not value:
+        raise PemError('zero RSA parameter')
+    return value
+
+def _parse_rsa_public_key(der, offset=0):
+    # RSAPublicKey ::= SEQUENCE { modulus INTEGER, publicExponent INTEGER }
+    start, end = _expect(der, offset, _TAG_SEQUENCE)
+    nstart, nend = _expect(der, start, _TAG_INTEGER)
+    estart, eend = _expect(der, nend, _TAG_INTEGER)
+    return _unsigned(der, nstart, nend), _unsigned(der, estart, eend)
+
+def _parse_public_key(label, der):
+    if label == 'RSA PUBLIC KEY':
+        return _parse_rsa_public_key(der)
+    # SubjectPublicKeyInfo ::= SEQUENCE { algorithm AlgorithmIdentifier,
+    #                                     subjectPublicKey BIT STRING }
+    start, end = _expect(der, 0, _TAG_SEQUENCE)
+    astart, aend = _expect(der, start, _TAG_SEQUENCE)
+    ostart, oend = _expect(der, astart, _TAG_OID)
+    if der[ostart:oend] != _RSA_ENCRYPTION:
+        raise PemError('not an RSA public key')
+    bstart, bend = _expect(der, aend, _TAG_BIT_STRING)
+    if bstart == bend or der[bstart] != '\0':
+        raise PemError('bad subjectPublicKey')
+    return _parse_rsa_public_key(der, bstart + 1)
+
+def _parse_certificate(label, der):
+    # the Certificate SEQUENCE, without any trailing bytes
+    tag, start, end = _read_tlv(der, 0)
+    if tag != _TAG_SEQUENCE:
+        raise PemError('not a DER certificate')
+    return der[:end]
+
+def _load(path, labels, parse):
+    st = os.stat(path)
+    key = (path, labels)
+    stamp = (st.st_size, st.st_mtime)
+    cached = _cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with open(path, 'r') as f:
+        text = f.read()
+    label, der = _find_block(text, labels)
+    value = parse(label, der)
+    _cache[key] = (stamp, value)
+    return value
+
+def read_rsa_public_key(path):
+    """
+    Return (modulus, exponent), big-endian byte strings without leading
+    zeros, for the first RSA public key (a PUBLIC KEY or RSA PUBLIC KEY
+    block) in the PEM file path.  Raises PemError if there is none.
+    """
+    return _load(path, ('PUBLIC KEY', 'RSA PUBLIC KEY'), _parse_public_key)
+
+def read_certificate(path):
+    """
+    Return the DER encoding of the first certificate in the PEM file path.
+    Raises PemError if there is none.
+    """
+    return _load(path, _CERT_LABELS, _parse_certificate)
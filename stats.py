@@ -0,0 +1,154 @@
+"""
+Per-phase timing and counters for the packaging tools.
+
+A Stats object accumulates, for each named phase, the wall-clock time, the
+process CPU time (user + system, of all threads and of any waited-for child
+processes) and the number of times the phase ran, plus any counters
+attached to the phase.  write() saves them as JSON; each counter is also
+reported as a rate over the phase's wall time, e.g. a 'files' counter on
+the 'hash' phase yields 'files_per_sec'.
+
+Phases may nest (the 'ldd' phase runs inside 'directives'), so their times
+overlap and do not sum to the total.
+"""
+
+import collections
+import cProfile
+import json
+import os
+import threading
+import time
+
+def _cpu():
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+class _Phase:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = _cpu()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add(self.name, time.time() - self.wall,
+                _cpu() - self.cpu)
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = collections.OrderedDict()
+
+    def _entry(self, name):
+        entry = self.phases.get(name)
+        if entry is None:
+            entry = {'wall': 0.0, 'cpu': 0.0, 'calls': 0,
+                     'counters': collections.OrderedDict()}
+            self.phases[name] = entry
+        return entry
+
+    def phase(self, name):
+        """
+        Return a context manager that times a run of phase name.
+        """
+        return _Phase(self, name)
+
+    def add(self, name, wall, cpu, calls=1):
+        with self._lock:
+            entry = self._entry(name)
+            entry['wall'] += wall
+            entry['cpu'] += cpu
+            entry['calls'] += calls
+
+    def count(self, name, counter, n=1):
+        with self._lock:
+            counters = self._entry(name)['counters']
+            counters[counter] = counters.get(counter, 0) + n
+
+    def merge(self, data):
+        """
+        Add in the phases of data, as loaded from another tool's JSON.
+        """
+        for name, entry in data.get('phases', {}).iteritems():
+            name = name.encode('utf-8')
+            self.add(name, entry['wall'], entry['cpu'], entry['calls'])
+            for counter, n in entry.get('counters', {}).iteritems():
+                if not counter.endswith('_per_sec'):
+                    self.count(name, counter.encode('utf-8'), n)
+
+    def as_dict(self):
+        with self._lock:
+            phases = collections.OrderedDict()
+            for name, entry in self.phases.iteritems():
+                out = collections.OrderedDict()
+                out['wall'] = round(entry['wall'], 6)
+                out['cpu'] = round(entry['cpu'], 6)
+                out['calls'] = entry['calls']
+                counters = collections.OrderedDict(entry['counters'])
+                for counter, n in entry['counters'].iteritems():
+                    if entry['wall'] > 0:
+                        counters[counter + '_per_sec'] = \
+                                round(n / entry['wall'], 3)
+                out['counters'] = counters
+                phases[name] = out
+        return {'phases': phases}
+
+    def write(self, path):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+            f.write('\n')
+        os.rename(tmp, path)
+
+def load(path):
+    with open(path) as f:
+        return json.load(f, object_pairs_hook=collections.OrderedDict)
+
+class NullStats:
+    """
+    Stands in for a Stats object when no statistics were asked for.
+    """
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def add(self, name, wall, cpu, calls=1):
+        pass
+
+    def count(self, name, counter, n=1):
+        pass
+
+    def merge(self, data):
+        pass
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_PHASE = _NullPhase()
+NULL_STATS = NullStats()
+
+class profiled:
+    """
+    Context manager that runs its body under cProfile and dumps the
+    profile to path, for pstats or snakeviz.  A path of None disables it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.profile = None
+
+    def __enter__(self):
+        if self.path:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.path)
@@ -0,0 +1,223 @@
+"""
+Expand the read-only trees of 'MOUNT ... chroot ro' mounts into the files
+they hold.
+
+walk_trees() walks several trees at once, one per thread, filtering each
+with a WalkPolicy: include/exclude globs, and what to do with symlinks,
+special files and empty files.  Every file it returns comes with the stat
+result the walk already made, so that the stages that hash the files need
+not stat them again.
+
+The default policy reproduces os.walk(): symlinks to files are kept,
+symlinks to directories are not descended into, and special and empty
+files are kept.  Directories are listed with scandir() when the scandir
+module is installed, which spares a stat of every subdirectory.
+
+A walk can also record stamps: the stat keys of everything whose change
+could change its result -- each directory listed (whose mtime moves when an
+entry is added, removed or renamed), the target of each symlink, and, when
+empty files are skipped, each regular file.  stamps_unchanged() then tells
+whether a walk would still return the same files, for the cost of a stat
+per directory rather than one per file.
+"""
+
+import collections
+import fnmatch
+import multiprocessing
+import os
+import stat
+from multiprocessing.pool import ThreadPool
+
+from checksums import stat_key
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+# symlinks
+KEEP = 'keep'
+FOLLOW = 'follow'
+SKIP = 'skip'
+# special files
+ERROR = 'error'
+
+SYMLINK_POLICIES = (KEEP, FOLLOW, SKIP)
+SPECIAL_POLICIES = (KEEP, SKIP, ERROR)
+EMPTY_POLICIES = (KEEP, SKIP)
+
+# include and exclude are tuples of glob patterns.  A pattern with a '/'
+# matches a path relative to the root of the tree; one without matches the
+# last component.  A file is kept if it matches an include pattern (or there
+# are none) and no exclude pattern; an excluded directory is not descended
+# into.
+WalkPolicy = collections.namedtuple('WalkPolicy',
+        ['include', 'exclude', 'symlinks', 'special', 'empty'])
+
+DEFAULT_POLICY = WalkPolicy((), (), KEEP, KEEP, KEEP)
+
+class WalkError(Exception):
+    pass
+
+def _matches(patterns, relpath, name):
+    for pattern in patterns:
+        if '/' in pattern:
+            if fnmatch.fnmatchcase(relpath, pattern):
+                return True
+        elif fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+def _scan(dirpath):
+    """
+    Return a list of (name, lst) for the entries of dirpath, where lst is
+    the entry's lstat, or None if it is a directory that scandir() told
+    apart without one.
+    """
+    entries = []
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            if entry.is_dir(follow_symlinks=False):
+                entries.append((entry.name, None))
+            else:
+                entries.append((entry.name, entry.stat(follow_symlinks=False)))
+        return entries
+    for name in os.listdir(dirpath):
+        entries.append((name, os.lstat(os.path.join(dirpath, name))))
+    return entries
+
+def stamp(path):
+    try:
+        return stat_key(os.stat(path))
+    except OSError:
+        return None
+
+def stamps_unchanged(stamps):
+    """
+    Return True if none of the (path, stat key) stamps a walk recorded has
+    changed.
+    """
+    for path, key in stamps:
+        if stamp(path) != key:
+            return False
+    return True
+
+def walk_tree(root, policy=DEFAULT_POLICY, skipped=None, stamps=None):
+    """
+    Return a list of (path, st) for the files under root that policy keeps.
+    st is the stat of the file (of its target, for a symlink), or None for
+    a dangling symlink.  Unreadable directories are passed over, as
+    os.walk() does.  If skipped is a list, the paths the policy drops are
+    appended to it; if stamps is, the walk's stamps are.
+    """
+    files = []
+    try:
+        st = os.stat(root)
+        ancestors = frozenset([(st.st_dev, st.st_ino)])
+    except OSError:
+        ancestors = frozenset()
+
+    # (directory, its path relative to root, the (dev, ino) of it and of
+    # the directories above it)
+    stack = [(root, '', ancestors)]
+    while stack:
+        dirpath, reldir, ancestors = stack.pop()
+        if stamps is not None:
+            # before listing, so that a change made during the walk shows
+            stamps.append((dirpath, stamp(dirpath)))
+        try:
+            entries = _scan(dirpath)
+        except OSError:
+            continue
+        for name, lst in entries:
+            path = os.path.join(dirpath, name)
+            relpath = reldir + name
+            st = lst
+
+            if lst is not None and stat.S_ISLNK(lst.st_mode):
+                if policy.symlinks == SKIP:
+                    if skipped is not None:
+                        skipped.append(path)
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    st = None
+                if stamps is not None:
+                    stamps.append((path, st and stat_key(st)))
+
+            if st is None and lst is None or \
+                    st is not None and stat.S_ISDIR(st.st_mode):
+                if lst is not None and stat.S_ISLNK(lst.st_mode):
+                    if policy.symlinks != FOLLOW:
+                        continue
+                    if (st.st_dev, st.st_ino) in ancestors:
+                        # a link back up the tree
+                        continue
+                if _matches(policy.exclude, relpath, name):
+                    continue
+                if st is not None:
+                    stack.append((path, relpath + '/',
+                                  ancestors | set([(st.st_dev, st.st_ino)])))
+                else:
+                    stack.append((path, relpath + '/', ancestors))
+                continue
+
+            if policy.include and \
+                    not _matches(policy.include, relpath, name) or \
+                    _matches(policy.exclude, relpath, name):
+                if skipped is not None:
+                    skipped.append(path)
+                continue
+            if st is not None and not stat.S_ISREG(st.st_mode):
+                if policy.special == ERROR:
+                    raise WalkError('%s: not a regular file' % path)
+                if policy.special == SKIP:
+                    if skipped is not None:
+                        skipped.append(path)
+                    continue
+            if policy.empty == SKIP and stamps is not None and \
+                    st is not None and stat.S_ISREG(st.st_mode):
+                stamps.append((path, stat_key(st)))
+            if policy.empty == SKIP and st is not None and \
+                    stat.S_ISREG(st.st_mode) and st.st_size == 0:
+                if skipped is not None:
+                    skipped.append(path)
+                continue
+            files.append((path, st))
+    return files
+
+def walk_trees(trees, jobs=None, skipped=None, stamps=None):
+    """
+    Walk each (root, policy) in trees, several at once, and return a list
+    with the result of walk_tree() for each.  If stamps is a list, a list
+    of the stamps of each walk is appended to it.
+    """
+    if len(trees) < 2:
+        results = []
+        for root, policy in trees:
+            mine = [] if stamps is not None else None
+            results.append(walk_tree(root, policy, skipped, mine))
+            if mine is not None:
+                stamps.append(mine)
+        return results
+
+    def work(tree):
+        root, policy = tree
+        mine = []
+        mine_stamps = [] if stamps is not None else None
+        files = walk_tree(root, policy, mine, mine_stamps)
+        return files, mine, mine_stamps
+
+    pool = ThreadPool(min(jobs or multiprocessing.cpu_count(), len(trees)))
+    try:
+        results = pool.map(work, trees, 1)
+    finally:
+        pool.close()
+        pool.join()
+    if skipped is not None:
+        for files, mine, mine_stamps in results:
+            skipped.extend(mine)
+    if stamps is not None:
+        stamps.extend(mine_stamps for files, mine, mine_stamps in results)
+    return [files for files, mine, mine_stamps in results]
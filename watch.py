@@ -0,0 +1,288 @@
+"""
+Watch a set of files and directory trees for changes.
+
+InotifyWatcher asks the kernel for events on the directories that hold the
+watched files (so that a file replaced by a rename is still seen) and on
+every directory of the watched trees.  PollWatcher stats the same set every
+few seconds, for hosts without inotify or when the kernel's watch limit is
+reached.  Both report changes as (path, kind) pairs, where kind is one of
+CREATED, DELETED or MODIFIED, and coalesce a burst of changes into a single
+report.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from checksums import stat_key
+
+CREATED = 'created'
+DELETED = 'deleted'
+MODIFIED = 'modified'
+
+DEFAULT_DEBOUNCE = 0.5
+DEFAULT_POLL_INTERVAL = 2.0
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_CLOEXEC = 0o2000000
+
+_IN_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+        _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF |
+        _IN_MOVE_SELF | _IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')
+
+def _walk_dirs(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        yield dirpath
+
+def _coalesce(changes):
+    # one entry per path; a creation or deletion trumps a modification
+    kinds = {}
+    order = []
+    for path, kind in changes:
+        if path not in kinds:
+            order.append(path)
+            kinds[path] = kind
+        elif kind != MODIFIED:
+            kinds[path] = kind
+    return [(path, kinds[path]) for path in order]
+
+def _stat_key(path):
+    try:
+        return stat_key(os.stat(path))
+    except OSError:
+        return None
+
+class PollWatcher:
+    def __init__(self, interval=DEFAULT_POLL_INTERVAL):
+        self.interval = interval
+        self._files = set()
+        self._trees = set()
+        self._snapshot = {}
+
+    def _scan(self):
+        snapshot = {}
+        for path in self._files:
+            snapshot[path] = _stat_key(path)
+        for root in self._trees:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    snapshot[path] = _stat_key(path)
+        return snapshot
+
+    def update(self, files, trees):
+        """
+        Watch exactly files and trees from now on.  Paths that were already
+        watched keep the state they had, so a change made since the last
+        wait() is still reported.
+        """
+        self._files = set(files)
+        self._trees = set(trees)
+        old = self._snapshot
+        self._snapshot = self._scan()
+        for path in self._snapshot:
+            if path in old:
+                self._snapshot[path] = old[path]
+
+    def _diff(self):
+        snapshot = self._scan()
+        changes = []
+        for path, key in snapshot.iteritems():
+            old = self._snapshot.get(path, 0)
+            if old == key:
+                continue
+            if old is None or old == 0:
+                changes.append((path, CREATED))
+            elif key is None:
+                changes.append((path, DELETED))
+            else:
+                changes.append((path, MODIFIED))
+        for path in self._snapshot:
+            if path not in snapshot:
+                changes.append((path, DELETED))
+        self._snapshot = snapshot
+        return changes
+
+    def wait(self, debounce=DEFAULT_DEBOUNCE):
+        """
+        Block until something changes, then until nothing has changed for
+        debounce seconds, and return the list of (path, kind) changes.
+        """
+        while True:
+            changes = self._diff()
+            if changes:
+                break
+            time.sleep(self.interval)
+        while True:
+            time.sleep(max(debounce, 0.1))
+            more = self._diff()
+            if not more:
+                return _coalesce(changes)
+            changes.extend(more)
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(_IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        # wd -> directory, and directory -> wd
+        self._dirs = {}
+        self._wds = {}
+        # directory -> names of the watched files in it
+        self._names = {}
+        self._trees = set()
+
+    def _watch_dir(self, path):
+        if path in self._wds:
+            return
+        wd = self._add_watch(self.fd, path, _IN_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(e, '%s: %s' % (path, os.strerror(e)))
+        self._dirs[wd] = path
+        self._wds[path] = wd
+
+    def _in_tree(self, path):
+        for root in self._trees:
+            if path == root or path.startswith(root.rstrip('/') + '/'):
+                return True
+        return False
+
+    def update(self, files, trees):
+        """
+        Watch exactly files and trees from now on.  Raises OSError if the
+        kernel refuses a watch, e.g. because its watch limit is reached.
+        """
+        self._trees = set(os.path.abspath(t) for t in trees)
+        self._names = {}
+        for path in files:
+            path = os.path.abspath(path)
+            dirname, name = os.path.split(path)
+            self._names.setdefault(dirname, set()).add(name)
+        wanted = set(self._names)
+        for root in self._trees:
+            wanted.update(_walk_dirs(root))
+        for path in list(self._wds):
+            if path not in wanted:
+                self._rm_watch(self.fd, self._wds.pop(path))
+        for path in wanted:
+            self._watch_dir(path)
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+        changes = []
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            wd, mask, cookie, namelen = _EVENT.unpack_from(data, pos)
+            name = data[pos + _EVENT.size:pos + _EVENT.size + namelen]
+            name = name.rstrip('\0')
+            pos += _EVENT.size + namelen
+
+            if mask & _IN_Q_OVERFLOW:
+                # events were dropped; have the caller redo everything
+                changes.extend((root, CREATED) for root in self._trees)
+                for dirname, names in self._names.iteritems():
+                    changes.extend((os.path.join(dirname, n), MODIFIED)
+                            for n in names)
+                continue
+            dirname = self._dirs.get(wd)
+            if mask & _IN_IGNORED:
+                if dirname is not None and self._wds.get(dirname) == wd:
+                    del self._wds[dirname]
+                self._dirs.pop(wd, None)
+                continue
+            if dirname is None:
+                continue
+            if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+                if self._in_tree(dirname):
+                    changes.append((dirname, DELETED))
+                continue
+            path = os.path.join(dirname, name)
+            if mask & (_IN_CREATE | _IN_MOVED_TO):
+                kind = CREATED
+            elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                kind = DELETED
+            else:
+                kind = MODIFIED
+            if self._in_tree(dirname):
+                if mask & _IN_ISDIR and kind == CREATED:
+                    for d in _walk_dirs(path):
+                        self._watch_dir(d)
+                changes.append((path, kind))
+            elif name in self._names.get(dirname, ()):
+                # a watched file replaced by a rename is a modification
+                changes.append((path, MODIFIED))
+        return changes
+
+    def wait(self, debounce=DEFAULT_DEBOUNCE):
+        """
+        Block until something changes, then until nothing has changed for
+        debounce seconds, and return the list of (path, kind) changes.
+        """
+        changes = []
+        timeout = None
+        while True:
+            try:
+                r, w, x = select.select([self.fd], [], [], timeout)
+            except select.error as e:
+                # a signal, e.g. SIGCHLD from a signing child
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not r:
+                if changes:
+                    return _coalesce(changes)
+                timeout = None
+                continue
+            changes.extend(self._read_events())
+            if changes:
+                timeout = debounce
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def make_watcher(poll_interval=DEFAULT_POLL_INTERVAL):
+    """
+    Return an InotifyWatcher, or a PollWatcher if inotify is unavailable.
+    """
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError):
+        return PollWatcher(poll_interval)